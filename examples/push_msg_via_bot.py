@@ -1,5 +1,4 @@
 import base64
-import hashlib
 import os
 
 import work_wechat
@@ -31,18 +30,13 @@ We investigating it.
 def push_img():
     img_blob = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAoAAAABCAYAAADn9T9+AAAAEElEQVR42mNkYPhfz0AEAAA4hwGA8wQHOAAAAABJRU5ErkJggg==')
     """
-    or  
-        with open("path/to/img.png", "rb") as f:
-            img_blob = f.read()
+    or pass a path directly:
+        work_wechat.WorkWeChat().webhook_send(key=webhook_key, image="path/to/img.png")
     """
 
-    image_base64 = base64.b64encode(img_blob).decode('utf8')
-    image_md5 = hashlib.md5(img_blob).hexdigest()
-
     work_wechat.WorkWeChat().webhook_send(
         key=webhook_key,
-        image_base64=image_base64,
-        image_md5=image_md5,
+        image=img_blob,
     )
 
 
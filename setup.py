@@ -15,10 +15,14 @@ setup(
     requires=[
         'requests',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.6',
 )
@@ -0,0 +1,123 @@
+"""
+代替 requests.Session / aiohttp.ClientSession 的桩，测试不访问网络：
+
+    session = StubSession({"/user/get": lambda params, body: dict(errcode=0, errmsg="ok", userid=params["userid"])})
+    ww = work_wechat.WorkWeChat(corpid="corpid", corpsecret="corpsecret", session=session)
+
+routes 为 {path: handler(params, body)} ，handler 返回响应 dict ，或者 (HTTP 状态码, 响应 dict) ，也可以抛出异常模拟网络错误；
+AsyncStubSession 的 handler 还可以返回 awaitable 。没有配置的 /gettoken 返回 access_token tok1 、tok2 ……，其他 path 返回 errcode 0 。
+"""
+import asyncio
+import json
+import threading
+import urllib.parse
+
+
+class StubResponse(object):
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.status = status_code
+        self.content = content
+        self.headers = {"Content-Type": "application/json"}
+
+    def iter_content(self, chunk_size: int = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class StubSession(object):
+
+    def __init__(self, routes: dict = None):
+        self.routes = dict(routes or {})
+        self.calls = []
+        self._lock = threading.Lock()
+        self._tokens = 0
+
+    def calls_to(self, path: str) -> list:
+        return [i for i in self.calls if i[1] == path]
+
+    def _handle(self, method: str, url: str, data):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path[len("/cgi-bin"):]
+        params = dict(urllib.parse.parse_qsl(parts.query))
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        with self._lock:
+            self.calls.append((method, path, params, data))
+        handler = self.routes.get(path)
+        if handler is not None:
+            return handler(params, data)
+        if path == "/gettoken":
+            with self._lock:
+                self._tokens += 1
+                return dict(errcode=0, errmsg="ok", access_token="tok%d" % self._tokens, expires_in=7200)
+        return dict(errcode=0, errmsg="ok")
+
+    @staticmethod
+    def _response(rs) -> StubResponse:
+        status_code = 200
+        if isinstance(rs, tuple):
+            status_code, rs = rs
+        return StubResponse(status_code, json.dumps(rs).encode("utf8"))
+
+    def request(self, method: str, url: str, timeout=None, data=None, headers=None, stream: bool = False):
+        return self._response(self._handle(method, url, data))
+
+    def close(self):
+        pass
+
+
+class _AsyncStubContent(object):
+    def __init__(self, content: bytes):
+        self._content = content
+
+    async def iter_chunked(self, n: int):
+        for i in range(0, len(self._content), n):
+            yield self._content[i:i + n]
+
+
+class _AsyncStubRequest(object):
+    def __init__(self, session: "AsyncStubSession", method: str, url: str, data):
+        self._session = session
+        self._method = method
+        self._url = url
+        self._data = data
+
+    async def __aenter__(self):
+        data = self._data
+        if hasattr(data, "__aiter__"):
+            data = b"".join([i async for i in data])
+        rs = self._session._handle(self._method, self._url, data)
+        if asyncio.iscoroutine(rs) or isinstance(rs, asyncio.Future):
+            rs = await rs
+        r = self._session._response(rs)
+        r.content = _AsyncStubContent(r.content)
+        r.read = self._read(r.content._content)
+        return r
+
+    @staticmethod
+    def _read(content: bytes):
+        async def read():
+            return content
+
+        return read
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class AsyncStubSession(StubSession):
+
+    def request(self, method: str, url: str, timeout=None, data=None, headers=None):
+        return _AsyncStubRequest(self, method, url, data)
+
+    async def close(self):
+        pass
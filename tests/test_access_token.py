@@ -0,0 +1,85 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import work_wechat
+from _stub_session import AsyncStubSession, StubSession
+
+
+def _slow_gettoken(expires_in: int = 7200):
+    count = [0]
+    lock = threading.Lock()
+
+    def handler(params, body):
+        time.sleep(0.1)
+        with lock:
+            count[0] += 1
+            return dict(errcode=0, errmsg="ok", access_token="tok%d" % count[0], expires_in=expires_in)
+
+    return handler
+
+
+def test_single_flight_threads():
+    session = StubSession({"/gettoken": _slow_gettoken()})
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        tokens = list(executor.map(lambda _: ww.get_access_token(), range(20)))
+    assert tokens == ["tok1"] * 20
+    assert len(session.calls_to("/gettoken")) == 1
+
+
+def test_single_flight_coroutines():
+    async def slow_gettoken(params, body):
+        await asyncio.sleep(0.1)
+        return dict(errcode=0, errmsg="ok", access_token="atok", expires_in=7200)
+
+    session = AsyncStubSession({"/gettoken": lambda params, body: slow_gettoken(params, body)})
+
+    async def main():
+        ww = work_wechat.AsyncWorkWeChat(corpid="c", corpsecret="s", session=session)
+        tokens = await asyncio.gather(*[ww.get_access_token() for _ in range(20)])
+        await ww.close()
+        return tokens
+
+    assert asyncio.run(main()) == ["atok"] * 20
+    assert len(session.calls_to("/gettoken")) == 1
+
+
+def test_invalid_token_refreshed_and_retried():
+    def user_get(params, body):
+        if params["access_token"] == "tok1":
+            return dict(errcode=work_wechat.ErrCode.INVALID_ACCESS_TOKEN, errmsg="invalid access_token")
+        return dict(errcode=0, errmsg="ok", userid=params["userid"])
+
+    session = StubSession({"/user/get": user_get})
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session)
+    assert ww.user_get("zhangsan")["userid"] == "zhangsan"
+    assert [i[2]["access_token"] for i in session.calls_to("/user/get")] == ["tok1", "tok2"]
+    assert len(session.calls_to("/gettoken")) == 2
+
+
+def test_token_store_shared(tmp_path):
+    store = work_wechat.FileTokenStore(str(tmp_path / "token.json"))
+    session = StubSession()
+    ww1 = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, token_store=store)
+    ww2 = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, token_store=store)
+    ww3 = work_wechat.WorkWeChat(corpid="c", corpsecret="other", session=session, token_store=store)
+    assert ww1.get_access_token() == ww2.get_access_token() == "tok1"
+    assert ww3.get_access_token() == "tok2"
+    assert len(session.calls_to("/gettoken")) == 2
+
+
+def test_renewer_refreshes_before_expiry():
+    session = StubSession({"/gettoken": _slow_gettoken(expires_in=3)})
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, token_refresh_margin=2)
+    try:
+        assert ww.get_access_token() == "tok1"
+        # token 还没过期，后台线程在过期前 2 秒刷新，get_access_token 不会自己调用 /gettoken
+        deadline = time.time() + 5
+        while ww.get_access_token() == "tok1" and time.time() < deadline:
+            time.sleep(0.05)
+        assert ww.get_access_token() == "tok2"
+        assert len(session.calls_to("/gettoken")) == 2
+    finally:
+        ww.close()
@@ -0,0 +1,187 @@
+import json
+import queue
+import threading
+import time
+
+import pytest
+
+import work_wechat
+from work_wechat import MessageDispatcher, MsgType, OverflowPolicy, WebhookDispatcher
+
+from _stub_session import StubSession
+
+
+def _blocked_client(path: str = "/message/send"):
+    """path 在 release 之前一直阻塞"""
+    release = threading.Event()
+
+    def send(params, body):
+        release.wait(10)
+        return dict(errcode=0, errmsg="ok", invaliduser="")
+
+    session = StubSession({path: send})
+    return work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session), session, release
+
+
+def _send(dispatcher: MessageDispatcher, userid: str):
+    return dispatcher.message_send(agentid=1, msgtype=MsgType.TEXT, content="hello", touser=(userid,))
+
+
+def _fill(dispatcher: MessageDispatcher):
+    """后台线程取走第一条并阻塞在发送上，再把队列填满"""
+    futures = [_send(dispatcher, "first")]
+    deadline = time.monotonic() + 5
+    while dispatcher.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    futures.append(_send(dispatcher, "queued"))
+    return futures
+
+
+def _start(n: int, target) -> list:
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+    for i in threads:
+        i.start()
+    return threads
+
+
+def test_block_producers_wait_concurrently():
+    ww, session, release = _blocked_client()
+    dispatcher = MessageDispatcher(ww, workers=1, maxsize=1, overflow=OverflowPolicy.BLOCK, put_timeout=0.5)
+    try:
+        _fill(dispatcher)
+        elapsed = [None] * 4
+
+        def produce(i):
+            start = time.monotonic()
+            with pytest.raises(queue.Full):
+                _send(dispatcher, "u%d" % i)
+            elapsed[i] = time.monotonic() - start
+
+        for i in _start(4, produce):
+            i.join()
+        # 各生产者同时等待 put_timeout ，而不是排队依次等待
+        assert all(0.4 < i < 0.9 for i in elapsed), elapsed
+    finally:
+        release.set()
+        dispatcher.close()
+
+
+def test_close_waits_for_blocked_producers():
+    ww, session, release = _blocked_client()
+    dispatcher = MessageDispatcher(ww, workers=1, maxsize=1, overflow=OverflowPolicy.BLOCK)
+    futures = _fill(dispatcher)
+    lock = threading.Lock()
+
+    def produce(i):
+        future = _send(dispatcher, "u%d" % i)
+        with lock:
+            futures.append(future)
+
+    producers = _start(4, produce)
+    time.sleep(0.1)
+    closer = threading.Thread(target=dispatcher.close)
+    closer.start()
+    time.sleep(0.1)
+    with pytest.raises(RuntimeError):
+        _send(dispatcher, "late")
+
+    release.set()
+    for i in producers + [closer]:
+        i.join(5)
+    assert not closer.is_alive()
+    # close 之前已经开始入队的消息都会发送
+    assert len(futures) == 6
+    assert all(i.result(0) == dict(invaliduser="") for i in futures)
+    sent = set()
+    for _, _, _, body in session.calls_to("/message/send"):
+        sent.update(json.loads(body)["touser"].split("|"))
+    assert sent == {"first", "queued", "u0", "u1", "u2", "u3"}
+
+
+def test_merged_send():
+    ww, session, release = _blocked_client()
+    dispatcher = MessageDispatcher(ww, workers=1, maxsize=10)
+    futures = _fill(dispatcher)
+    futures += [_send(dispatcher, "u%d" % i) for i in range(3)]
+    release.set()
+    dispatcher.close()
+    assert all(i.result(0) == dict(invaliduser="") for i in futures)
+    bodies = [json.loads(body) for _, _, _, body in session.calls_to("/message/send")]
+    assert [i["touser"] for i in bodies] == ["first", "queued|u0|u1|u2"]
+
+
+def _wait_busy(dispatcher: WebhookDispatcher):
+    """等待后台线程取走第一条消息"""
+    deadline = time.monotonic() + 5
+    while dispatcher.qsize() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_webhook_coalesce():
+    ww, session, release = _blocked_client("/webhook/send")
+    dispatcher = WebhookDispatcher(ww)
+    futures = [dispatcher.webhook_send(key="k", text_content="a")]
+    _wait_busy(dispatcher)
+    futures += [
+        dispatcher.webhook_send(key="k", text_content="b", mentioned_list=["u1"]),
+        dispatcher.webhook_send(key="k", text_content="c", mentioned_list=["u2", "u1"]),
+        dispatcher.webhook_send(key="k", markdown_content="**d**"),
+    ]
+    release.set()
+    dispatcher.close()
+    assert [i.result(0) for i in futures] == [None] * 4
+    bodies = [json.loads(body) for _, _, _, body in session.calls_to("/webhook/send")]
+    assert bodies == [
+        dict(msgtype="text", text=dict(content="a")),
+        dict(msgtype="text", text=dict(content="b\nc", mentioned_list=["u1", "u2"])),
+        dict(msgtype="markdown", markdown=dict(content="**d**")),
+    ]
+
+
+def test_webhook_rate_per_key():
+    sent = []
+
+    def send(params, body):
+        sent.append((params["key"], time.monotonic()))
+        return dict(errcode=0, errmsg="ok")
+
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=StubSession({"/webhook/send": send}))
+    dispatcher = WebhookDispatcher(ww, rate=(1, 0.2), coalesce=False)
+    start = time.monotonic()
+    futures = [dispatcher.webhook_send(key="a", text_content="%d" % i) for i in range(3)]
+    futures.append(dispatcher.webhook_send(key="b", text_content="b"))
+    dispatcher.close()
+    assert [i.result(0) for i in futures] == [None] * 4
+
+    times = [t - start for key, t in sent if key == "a"]
+    assert len(times) == 3
+    assert times[1] - times[0] > 0.15 and times[2] - times[1] > 0.15
+    # 其他 key 不受 a 的限流影响
+    (b,), = [[t - start for key, t in sent if key == "b"]]
+    assert b < 0.15
+
+
+def test_webhook_block_woken_by_close():
+    ww, session, release = _blocked_client("/webhook/send")
+    dispatcher = WebhookDispatcher(ww, maxsize=1, overflow=OverflowPolicy.BLOCK)
+    futures = [dispatcher.webhook_send(key="k", image_base64="aW1n", image_md5="m")]
+    _wait_busy(dispatcher)
+    futures.append(dispatcher.webhook_send(key="k", text_content="queued"))
+    errors = []
+
+    def produce(i):
+        try:
+            dispatcher.webhook_send(key="k", text_content="%d" % i)
+        except Exception as ex:
+            errors.append(ex)
+
+    producers = _start(3, produce)
+    time.sleep(0.1)
+    dispatcher.close(wait=False)
+    for i in producers:
+        i.join(5)
+    assert [type(i) for i in errors] == [RuntimeError] * 3
+
+    release.set()
+    dispatcher.close()
+    assert [i.result(0) for i in futures] == [None] * 2
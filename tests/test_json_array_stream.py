@@ -0,0 +1,86 @@
+import json
+import random
+
+import pytest
+
+from work_wechat import _JsonArrayStream
+
+RESPONSES = [
+    {"errcode": 0, "errmsg": "ok", "userlist": []},
+    {"errcode": 0, "errmsg": "ok", "userlist": [{"userid": "zhangsan", "name": "张三", "department": [1, 2]}]},
+    {
+        "errcode": 0,
+        "errmsg": "ok",
+        "userlist": [
+            {"userid": "u%d" % i, "name": "成员%d 😀" % i, "order": [i, -i * 1.5], "extattr": {"attrs": []}}
+            for i in range(50)
+        ],
+        "next_cursor": "abc\"\\\n",
+    },
+    {"userlist": [1, 22, 333, "4444", None, True, False, [], {}], "errcode": 0, "errmsg": "ok"},
+    {"errcode": 60003, "errmsg": "department not found"},
+]
+
+
+def _dumps(rs: dict, indent) -> bytes:
+    return json.dumps(rs, ensure_ascii=False, indent=indent).encode("utf8")
+
+
+def _feed(data: bytes, cuts) -> tuple:
+    stream = _JsonArrayStream("userlist")
+    items = []
+    pos = 0
+    for cut in list(cuts) + [len(data)]:
+        items.extend(stream.feed(data[pos:cut]))
+        pos = cut
+    return items, stream.finish()
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("rs", RESPONSES)
+def test_random_splits(rs, indent):
+    data = _dumps(rs, indent)
+    want = json.loads(data)
+    want_items = want.pop("userlist", [])
+    rnd = random.Random(len(data))
+    for _ in range(50):
+        cuts = sorted(rnd.sample(range(len(data)), min(len(data), rnd.randint(1, 20))))
+        items, envelope = _feed(data, cuts)
+        assert items == want_items
+        assert envelope == want
+
+
+@pytest.mark.parametrize("rs", RESPONSES)
+def test_byte_by_byte(rs):
+    data = _dumps(rs, None)
+    want = json.loads(data)
+    want_items = want.pop("userlist", [])
+    items, envelope = _feed(data, range(1, len(data)))
+    assert items == want_items
+    assert envelope == want
+
+
+@pytest.mark.parametrize("data", [
+    b'{"errcode": 0, "userlist": [{"userid": "a"}',
+    b'{"errcode": 0, "userlist": [1, 2',
+    b'{"errcode": 0',
+    b'',
+])
+def test_incomplete(data):
+    stream = _JsonArrayStream("userlist")
+    stream.feed(data)
+    with pytest.raises(ValueError):
+        stream.finish()
+
+
+@pytest.mark.parametrize("data", [
+    b'{"errcode": 0}{',
+    b'[{"errcode": 0}]',
+    b'{"errcode": 0, "userlist": {"userid": "a"}}',
+    b'{"errcode": 0 "errmsg": "ok"}',
+])
+def test_invalid(data):
+    stream = _JsonArrayStream("userlist")
+    with pytest.raises(ValueError):
+        stream.feed(data)
+        stream.finish()
@@ -0,0 +1,38 @@
+import gc
+
+from work_wechat import LikeDict, TextCard
+
+
+def _has_dict(obj) -> bool:
+    return any(isinstance(i, dict) for i in gc.get_referents(obj))
+
+
+def test_to_dict_does_not_allocate_dict():
+    card = TextCard(title="标题", description="描述", url="https://example.com")
+    assert card.to_dict(drop_none=True) == dict(title="标题", description="描述", url="https://example.com")
+    card.update(title="新标题", unknown="x")
+    assert card.to_dict()["title"] == "新标题"
+    repr(card)
+    assert not _has_dict(card)
+
+
+def test_extra_attributes():
+    card = TextCard(title="标题", description="描述", url="https://example.com")
+    card.appid = "wx123"
+    card._private = 1
+    assert card.to_dict(drop_none=True) == dict(title="标题", description="描述", url="https://example.com", appid="wx123")
+    card.update(appid="wx456")
+    assert card.appid == "wx456"
+    assert TextCard(title="a").to_dict(drop_none=True) == dict(title="a")
+
+
+def test_legacy_subclass():
+    class Legacy(LikeDict):
+        def __init__(self, a=None, b=None):
+            self.a = a
+            self.b = b
+
+    obj = Legacy(a=1)
+    assert obj.to_dict(drop_none=True) == dict(a=1)
+    obj.update(b=2, c=3)
+    assert obj.to_dict() == dict(a=1, b=2)
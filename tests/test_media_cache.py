@@ -0,0 +1,94 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+import work_wechat
+from work_wechat import Media, MediaCache
+
+from _stub_session import AsyncStubSession, StubSession
+
+
+def _uploaded(count: int) -> dict:
+    return dict(errcode=0, errmsg="ok", type="file", media_id="m%d" % count, created_at="%d" % time.time())
+
+
+def test_single_flight_threads():
+    count = [0]
+    lock = threading.Lock()
+
+    def upload(params, body):
+        time.sleep(0.1)
+        with lock:
+            count[0] += 1
+            return _uploaded(count[0])
+
+    session = StubSession({"/media/upload": upload})
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, media_cache=MediaCache())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+        media_ids = list(executor.map(lambda _: ww.media_upload(Media("a.txt", b"data")), range(10)))
+    assert media_ids == ["m1"] * 10
+    assert len(session.calls_to("/media/upload")) == 1
+    assert ww.media_upload(Media("b.txt", b"data")) == "m1"
+    assert ww.media_upload(Media("c.txt", b"other")) == "m2"
+
+
+def _async_client(upload):
+    session = AsyncStubSession({"/media/upload": upload})
+    return work_wechat.AsyncWorkWeChat(corpid="c", corpsecret="s", session=session, media_cache=MediaCache()), session
+
+
+def test_cancel_waiter():
+    count = [0]
+
+    async def slow_upload():
+        await asyncio.sleep(0.2)
+        count[0] += 1
+        return _uploaded(count[0])
+
+    ww, session = _async_client(lambda params, body: slow_upload())
+
+    async def main():
+        uploader = asyncio.ensure_future(ww.media_upload(Media("a.txt", b"data")))
+        await asyncio.sleep(0.05)
+        # 等待中的调用超时不影响正在上传的调用
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(ww.media_upload(Media("a.txt", b"data")), timeout=0.05)
+        assert await uploader == "m1"
+        assert await ww.media_upload(Media("a.txt", b"data")) == "m1"
+        await ww.close()
+
+    asyncio.run(main())
+    assert len(session.calls_to("/media/upload")) == 1
+    assert not ww._media_uploads
+
+
+def test_cancel_uploader():
+    count = [0]
+
+    async def upload():
+        count[0] += 1
+        if count[0] == 1:
+            await asyncio.sleep(10)
+        return _uploaded(count[0])
+
+    ww, session = _async_client(lambda params, body: upload())
+
+    async def main():
+        uploader = asyncio.ensure_future(ww.media_upload(Media("a.txt", b"data")))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.ensure_future(ww.media_upload(Media("a.txt", b"data")))
+        await asyncio.sleep(0.05)
+        uploader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await uploader
+        # 上传的协程被取消后，等待中的调用重新上传
+        assert await waiter == "m2"
+        assert await ww.media_upload(Media("a.txt", b"data")) == "m2"
+        await ww.close()
+
+    asyncio.run(main())
+    assert len(session.calls_to("/media/upload")) == 2
+    assert not ww._media_uploads
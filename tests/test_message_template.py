@@ -0,0 +1,105 @@
+import json
+import re
+
+import pytest
+
+import work_wechat
+from work_wechat import MessageTemplate, MsgType, NewsArticle, TaskCard, TaskCardBtn, TextCard, _WorkWeChatBase
+
+# 每个用例返回 message_send 的参数，字符串字段经过 fill 处理：模板中 fill 原样返回，期望结果中 fill 替换变量
+CASES = {
+    "text": lambda fill: dict(
+        msgtype=MsgType.TEXT,
+        agentid=1000002,
+        content=fill("${name}，你好：\n本月 ${amount} 元 (100%)"),
+    ),
+    "markdown": lambda fill: dict(
+        msgtype=MsgType.MARKDOWN,
+        agentid=1000002,
+        content=fill("**${name}**\n> ${amount}"),
+        enable_duplicate_check=1,
+    ),
+    "textcard": lambda fill: dict(
+        msgtype=MsgType.TEXTCARD,
+        agentid=1000002,
+        textcard=TextCard(
+            title=fill("${name}，你的报销已到账"),
+            description=fill("<div class=\"gray\">金额：${amount} 元</div>"),
+            url="https://example.com/?a=1&b=%20",
+        ),
+    ),
+    "news": lambda fill: dict(
+        msgtype=MsgType.NEWS,
+        agentid=1000002,
+        news_articles=[
+            NewsArticle(title=fill("${name}"), url="https://example.com", picurl=None),
+            NewsArticle(title="第二篇", description=fill("${amount}${amount}"), url="https://example.com/2"),
+        ],
+    ),
+    "taskcard": lambda fill: dict(
+        msgtype=MsgType.TASKCARD,
+        agentid=1000002,
+        taskcard=TaskCard(
+            title="审批",
+            description=fill("${name} 申请 ${amount} 元"),
+            task_id=fill("task-${name}"),
+            btn=[TaskCardBtn(key="yes", name="批准"), TaskCardBtn(key="no", name="驳回", color="red")],
+        ),
+    ),
+}
+
+VARIABLES = [
+    dict(name="张三", amount=100),
+    dict(name="quote \" backslash \\ newline \n tab \t", amount=1.5),
+    dict(name="😀 %s %% ${amount}", amount="</script> \x00"),
+    dict(name="", amount=""),
+]
+
+RECIPIENTS = [
+    dict(touser=("zhangsan",)),
+    dict(touser=("zhangsan", "lisi"), toparty=("1", "2"), totag=("3",)),
+    dict(toparty=("1",)),
+    dict(),
+]
+
+
+def _fill(variables: dict):
+    return lambda text: re.sub(r"\$\{(\w+)\}", lambda m: "%s" % variables[m.group(1)], text)
+
+
+def _want(case, variables: dict, recipients: dict) -> bytes:
+    data = dict()
+    _WorkWeChatBase._set_message_recipients(data, **recipients)
+    data.update(_WorkWeChatBase._message_send_data(**case(_fill(variables))))
+    return json.dumps(
+        data, ensure_ascii=False, separators=(",", ":"), default=work_wechat._json_default,
+    ).encode("utf8")
+
+
+@pytest.mark.parametrize("recipients", RECIPIENTS)
+@pytest.mark.parametrize("variables", VARIABLES)
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_render_matches_message_send(name, variables, recipients):
+    case = CASES[name]
+    template = MessageTemplate(**case(lambda text: text))
+    body = template.render(variables, **recipients)
+    assert body == _want(case, variables, recipients)
+    assert json.loads(body.decode("utf8")) == json.loads(_want(case, variables, recipients).decode("utf8"))
+
+
+def test_variables():
+    template = MessageTemplate(**CASES["taskcard"](lambda text: text))
+    assert template.variables == {"name", "amount"}
+
+
+def test_missing_variable():
+    template = MessageTemplate(**CASES["text"](lambda text: text))
+    with pytest.raises(KeyError, match="amount"):
+        template.render(dict(name="张三"), touser=("zhangsan",))
+
+
+def test_no_variables():
+    case = lambda fill: dict(msgtype=MsgType.TEXT, agentid=1, content="100% 固定内容")
+    template = MessageTemplate(**case(None))
+    assert template.variables == frozenset()
+    assert template.render(touser=("a",)) == _want(case, dict(), dict(touser=("a",)))
@@ -0,0 +1,78 @@
+import asyncio
+
+import work_wechat
+from work_wechat import ErrCode, Metrics, RequestHooks
+
+from _stub_session import AsyncStubSession, StubSession
+
+
+class RecordingHooks(RequestHooks):
+    def __init__(self):
+        self.events = []
+
+    def after_response(self, request, rs):
+        self.events.append(("after_response", request.path))
+
+    def on_error(self, request, ex):
+        self.events.append(("on_error", request.path, type(ex).__name__))
+
+
+def _user_list(params, body):
+    return dict(errcode=0, errmsg="ok", userlist=[dict(userid="u%d" % i) for i in range(100)])
+
+
+def _client(routes: dict):
+    metrics = Metrics()
+    hooks = RecordingHooks()
+    session = StubSession(routes)
+    ww = work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, metrics=metrics, hooks=[hooks])
+    return ww, metrics, hooks
+
+
+def test_accepted_errcode_is_not_error():
+    ww, metrics, hooks = _client({
+        "/user/get": lambda params, body: dict(errcode=ErrCode.USERID_NOT_FOUND, errmsg="userid not found"),
+        "/department/list": lambda params, body: dict(errcode=ErrCode.DEPARTMENT_NOT_FOUND, errmsg="not found"),
+    })
+    assert ww.user_get("x") is None
+    try:
+        ww.department_list(1)
+    except work_wechat.WorkWeChatException:
+        pass
+    snapshot = metrics.snapshot()
+    assert snapshot["requests"]["/user/get"] == {"60111": 1}
+    assert "/user/get" not in snapshot["errors"]
+    assert snapshot["errors"]["/department/list"] == {"60003": 1}
+    assert ("after_response", "/user/get") in hooks.events
+    assert ("on_error", "/department/list", "WorkWeChatException") in hooks.events
+
+
+def test_stream_break_is_not_error():
+    ww, metrics, hooks = _client({"/user/list": _user_list})
+    for i in ww.iter_user_list(1):
+        break
+    snapshot = metrics.snapshot()
+    assert snapshot["requests"]["/user/list"] == {"0": 1}
+    assert "/user/list" not in snapshot["errors"]
+    assert snapshot["in_flight"].get("/user/list", 0) == 0
+    assert [i for i in hooks.events if i[1] == "/user/list"] == [("after_response", "/user/list")]
+
+
+def test_async_stream_aclose_is_not_error():
+    metrics = Metrics()
+    hooks = RecordingHooks()
+    session = AsyncStubSession({"/user/list": _user_list})
+
+    async def main():
+        ww = work_wechat.AsyncWorkWeChat(corpid="c", corpsecret="s", session=session, metrics=metrics, hooks=[hooks])
+        users = ww.iter_user_list(1)
+        async for i in users:
+            break
+        await users.aclose()
+        await ww.close()
+
+    asyncio.run(main())
+    snapshot = metrics.snapshot()
+    assert snapshot["requests"]["/user/list"] == {"0": 1}
+    assert "/user/list" not in snapshot["errors"]
+    assert [i for i in hooks.events if i[1] == "/user/list"] == [("after_response", "/user/list")]
@@ -0,0 +1,103 @@
+import io
+import os
+import pathlib
+import re
+import tempfile
+
+import pytest
+
+from work_wechat import _MultipartStream
+
+
+def _parse(body: bytes, boundary: str) -> list:
+    """按 RFC 7578 拆分请求体，返回 [(headers, 内容)]"""
+    delimiter = ("--%s" % boundary).encode("utf8")
+    assert body.endswith(delimiter + b"--\r\n")
+    parts = body[:-len(delimiter + b"--\r\n")].split(delimiter)
+    assert parts[0] == b""
+    rs = []
+    for part in parts[1:]:
+        assert part.startswith(b"\r\n") and part.endswith(b"\r\n")
+        head, content = part[2:-2].split(b"\r\n\r\n", 1)
+        headers = dict(line.split(": ", 1) for line in head.decode("utf8").split("\r\n"))
+        rs.append((headers, content))
+    return rs
+
+
+def _read_all(stream: _MultipartStream, chunk_size: int) -> bytes:
+    return b"".join(iter(lambda: stream.read(chunk_size), b""))
+
+
+@pytest.fixture
+def file_path():
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        f.write(os.urandom(100000))
+    yield pathlib.Path(path)
+    os.remove(path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 1 << 20])
+def test_parse_back(file_path, chunk_size):
+    file_obj = io.BytesIO(b"skipped" + b"file object")
+    file_obj.seek(len(b"skipped"))
+    files = {
+        "media": ("中文 \"名\"\r\n.jpg", b"bytes data", "image/jpeg"),
+        "view": ("view.bin", memoryview(b"0123456789")[2:8], None),
+        "obj": ("obj.txt", file_obj, "text/plain"),
+        "path": ("path.bin", file_path, "application/octet-stream"),
+        "empty": ("empty.txt", b"", "text/plain"),
+    }
+    stream = _MultipartStream(files)
+    try:
+        body = _read_all(stream, chunk_size)
+    finally:
+        stream.close()
+
+    assert len(body) == len(stream)
+    assert stream.content_type == "multipart/form-data; boundary=%s" % stream.boundary
+    parts = _parse(body, stream.boundary)
+    want = [
+        ("media", "中文 %22名%22%0D%0A.jpg", "image/jpeg", b"bytes data"),
+        ("view", "view.bin", "application/octet-stream", b"234567"),
+        ("obj", "obj.txt", "text/plain", b"file object"),
+        ("path", "path.bin", "application/octet-stream", file_path.read_bytes()),
+        ("empty", "empty.txt", "text/plain", b""),
+    ]
+    assert len(parts) == len(want)
+    for (headers, content), (name, file_name, file_type, data) in zip(parts, want):
+        disposition = re.fullmatch(
+            r'form-data; name="(.*)"; filename="(.*)"; filelength=(\d+)', headers["Content-Disposition"],
+        )
+        assert disposition.groups() == (name, file_name, "%d" % len(data))
+        assert headers["Content-Type"] == file_type
+        assert content == data
+
+
+def test_seek_and_reread(file_path):
+    stream = _MultipartStream({"media": ("a.bin", file_path, None)})
+    try:
+        body = _read_all(stream, 1000)
+        assert stream.read() == b""
+        assert stream.seek(0) == 0
+        assert stream.read() == body
+        assert stream.seek(-10, os.SEEK_END) == len(body) - 10
+        assert stream.read(100) == body[-10:]
+    finally:
+        stream.close()
+
+
+def test_non_seekable_stream():
+    class Pipe(io.RawIOBase):
+        def __init__(self, data: bytes):
+            self._data = io.BytesIO(data)
+
+        def readable(self) -> bool:
+            return True
+
+        def readinto(self, b) -> int:
+            return self._data.readinto(b)
+
+    stream = _MultipartStream({"media": ("a.txt", Pipe(b"piped data"), "text/plain")})
+    (_, content), = _parse(_read_all(stream, 3), stream.boundary)
+    assert content == b"piped data"
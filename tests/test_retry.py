@@ -0,0 +1,110 @@
+import io
+import typing
+
+import pytest
+import requests
+
+import work_wechat
+from _stub_session import StubSession
+
+
+def _flaky(*failures):
+    """依次返回 failures 中的结果（异常则抛出），之后都成功"""
+    failures = list(failures)
+
+    def handler(params, body):
+        if failures:
+            rs = failures.pop(0)
+            if isinstance(rs, Exception):
+                raise rs
+            return rs
+        return dict(errcode=0, errmsg="ok", userid="zhangsan", media_id="m1", type="file", created_at="1")
+
+    return handler
+
+
+def _client(routes: dict, **kwargs) -> typing.Tuple[work_wechat.WorkWeChat, StubSession]:
+    session = StubSession(routes)
+    policy = work_wechat.RetryPolicy(backoff_base=0, **kwargs)
+    return work_wechat.WorkWeChat(corpid="c", corpsecret="s", session=session, retry_policy=policy), session
+
+
+@pytest.mark.parametrize("failure", [
+    (502, dict()),
+    dict(errcode=work_wechat.ErrCode.ERROR, errmsg="system busy"),
+    requests.exceptions.ReadTimeout(),
+    requests.exceptions.ConnectTimeout(),
+])
+def test_idempotent_retried(failure):
+    ww, session = _client({"/user/get": _flaky(failure)})
+    assert ww.user_get("zhangsan")["userid"] == "zhangsan"
+    assert len(session.calls_to("/user/get")) == 2
+
+
+@pytest.mark.parametrize("failure, retried", [
+    (dict(errcode=work_wechat.ErrCode.API_FREQ_OUT_OF_LIMIT, errmsg="freq out of limit"), True),
+    (requests.exceptions.ConnectTimeout(), True),
+    (dict(errcode=work_wechat.ErrCode.ERROR, errmsg="system busy"), False),
+    ((502, dict()), False),
+    (requests.exceptions.ReadTimeout(), False),
+])
+def test_non_idempotent_retried_only_if_not_processed(failure, retried):
+    ww, session = _client({"/message/send": _flaky(failure)})
+    if retried:
+        ww.message_send(agentid=1, msgtype="text", content="hello", touser=("zhangsan",))
+    else:
+        with pytest.raises((work_wechat.WorkWeChatException, work_wechat.HTTPStatusError, requests.exceptions.ReadTimeout)):
+            ww.message_send(agentid=1, msgtype="text", content="hello", touser=("zhangsan",))
+    assert len(session.calls_to("/message/send")) == (2 if retried else 1)
+
+
+def test_max_retries():
+    ww, session = _client({"/user/get": lambda params, body: (503, dict())}, max_retries=2)
+    with pytest.raises(work_wechat.HTTPStatusError):
+        ww.user_get("zhangsan")
+    assert len(session.calls_to("/user/get")) == 3
+
+
+def test_not_retried_errcode():
+    ww, session = _client({"/user/get": _flaky(dict(errcode=work_wechat.ErrCode.USERID_NOT_FOUND, errmsg="no user"))})
+    assert ww.user_get("zhangsan") is None
+    assert len(session.calls_to("/user/get")) == 1
+
+
+def test_budget():
+    ww, session = _client({"/user/get": lambda params, body: (503, dict())}, budget_max=1, budget_ratio=0)
+    for _ in range(3):
+        with pytest.raises(work_wechat.HTTPStatusError):
+            ww.user_get("zhangsan")
+    # 预算只够重试一次
+    assert len(session.calls_to("/user/get")) == 4
+
+
+def test_upload_retry_from_start_offset():
+    ww, session = _client({"/media/upload": _flaky((502, dict()))})
+    f = io.BytesIO(b"HEADER" + b"payload")
+    f.seek(len(b"HEADER"))
+    assert ww.media_upload(work_wechat.Media("a.txt", f)) == "m1"
+    bodies = [i[3] for i in session.calls_to("/media/upload")]
+    assert len(bodies) == 2
+    for body in bodies:
+        assert b"payload" in body and b"HEADER" not in body
+    assert f.tell() == len(b"HEADER" + b"payload")
+
+
+def test_upload_retry_non_seekable_stream():
+    class Pipe(io.RawIOBase):
+        def __init__(self, data: bytes):
+            self._data = io.BytesIO(data)
+
+        def readable(self) -> bool:
+            return True
+
+        def readinto(self, b) -> int:
+            return self._data.readinto(b)
+
+    ww, session = _client({"/media/upload": _flaky((502, dict()))})
+    assert ww.media_upload(work_wechat.Media("a.txt", Pipe(b"piped data"))) == "m1"
+    bodies = [i[3] for i in session.calls_to("/media/upload")]
+    assert len(bodies) == 2
+    assert all(b"piped data" in body for body in bodies)
@@ -0,0 +1,25 @@
+import logging
+
+import work_wechat
+from _stub_session import StubSession
+
+
+def test_secrets_not_logged(caplog):
+    session = StubSession({"/user/get": lambda params, body: dict(errcode=0, errmsg="ok", userid=params["userid"])})
+    ww = work_wechat.WorkWeChat(corpid="ww-corp", corpsecret="s3cret-value", verbose=True, session=session)
+    with caplog.at_level(logging.DEBUG):
+        ww.user_get("zhangsan")
+        ww.webhook_send(key="webhook-key-value", text_content="hello")
+
+    urls = [r.getMessage() for r in caplog.records if "/cgi-bin/" in r.getMessage()]
+    assert len(urls) == 3
+    assert "corpid=ww-corp" in urls[0] and "corpsecret=%2A%2A%2A" in urls[0]
+    assert "userid=zhangsan" in urls[1]
+    for i in urls:
+        assert "s3cret-value" not in i
+        assert "tok1" not in i
+        assert "webhook-key-value" not in i
+
+    # 发出的请求不受影响
+    assert session.calls[0][2]["corpsecret"] == "s3cret-value"
+    assert session.calls[1][2]["access_token"] == "tok1"
@@ -1,32 +1,132 @@
 import copy
+import asyncio
+import binascii
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import mmap
+import operator
+import os
+import pathlib
+import queue
+import random
+import re
+import sqlite3
+import threading
 import time
 import typing
 import urllib.parse
 import requests
+import requests.adapters
+import urllib3.exceptions
 import mimetypes
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 
 class LikeDict(object):
-    def __init__(self, **kwargs):
-        self.update(**kwargs)
+    """
+    消息中的结构体，子类在 __slots__ 中声明字段，字段默认为 None ；字段列表和取值函数在定义子类时预先生成，序列化请求时去掉值为 None 的字段。
+    __slots__ 中加上 "__dict__" 时，实例上设置的其他公开属性（SDK 未声明的接口字段）也会被 to_dict() 序列化。
+
+    兼容在 __init__ 中给 self 赋值声明字段的旧写法（没有 __slots__ 的子类）。
+    """
+
+    __slots__ = ()
+
+    _fields = ()
+    _field_set = frozenset()
+    _getter = staticmethod(lambda obj: ())
+    # 设置其他属性时保存到实例的 __dict__ 中，没有设置过时读取 __dict__ 会为每个实例创建一个空 dict
+    _has_extra = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = []
+        extra = False
+        for klass in reversed(cls.__mro__):
+            slots = klass.__dict__.get("__slots__", ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            extra = extra or "__dict__" in slots
+            for i in slots:
+                if not i.startswith("_") and i not in fields:
+                    fields.append(i)
+        if extra:
+            cls.__setattr__ = LikeDict._setattr_extra
+        elif "__slots__" not in cls.__dict__:
+            # 旧写法的子类实例总有 __dict__
+            cls._has_extra = True
+        cls._fields = tuple(fields)
+        cls._field_set = frozenset(fields)
+        if len(fields) > 1:
+            cls._getter = staticmethod(operator.attrgetter(*fields))
+        elif fields:
+            getter = operator.attrgetter(fields[0])
+            cls._getter = staticmethod(lambda obj: (getter(obj),))
+
+    def _setattr_extra(self, name: str, value):
+        if name not in self._field_set:
+            object.__setattr__(self, "_has_extra", True)
+        object.__setattr__(self, name, value)
 
-    def to_dict(self) -> dict:
-        return dict((k, v) for k, v in self.__dict__.items() if not k.startswith("_"))
+    def __init__(self, **kwargs):
+        for k in self._fields:
+            setattr(self, k, kwargs.pop(k, None))
+        if kwargs:
+            self.update(**kwargs)
+
+    def to_dict(self, drop_none: bool = False) -> dict:
+        """drop_none 为 True 时去掉值为 None 的字段"""
+        if drop_none:
+            d = {k: v for k, v in zip(self._fields, self._getter(self)) if v is not None}
+        else:
+            d = dict(zip(self._fields, self._getter(self)))
+        if self._has_extra:
+            d.update((k, v) for k, v in self.__dict__.items() if not k.startswith("_") and not (drop_none and v is None))
+        return d
 
     def update(self, **kwargs):
+        attrs = self.__dict__ if self._has_extra else ()
         for k, v in kwargs.items():
-            if k in self.__dict__:
-                self.__dict__[k] = v
+            if k in self._field_set or k in attrs:
+                setattr(self, k, v)
+
+    def __repr__(self) -> str:
+        return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % i for i in self.to_dict(drop_none=True).items()))
 
 
 class ErrCode:
     ERROR = -1
     SUCCESS = 0
 
+    INVALID_ACCESS_TOKEN = 40014
     INVALID_USERID_LIST = 40031
     INVALID_PARTY_LIST = 40066
+    ACCESS_TOKEN_EXPIRED = 42001
+    API_FREQ_OUT_OF_LIMIT = 45009
+    API_CONCURRENT_OUT_OF_LIMIT = 45033
     API_FORBIDDEN = 48002
 
     DEPARTMENT_NOT_FOUND = 60003
@@ -49,6 +149,33 @@ class WorkWeChatException(Exception):
         return "%s" % self.rs
 
 
+class BatchDeleteError(WorkWeChatException):
+    """
+    user_batchdelete 部分批次删除失败，failed 为 {userid: 异常} ；
+    errcode 、errmsg 、rs 取自第一个接口错误，失败都不是接口错误（比如网络异常）时 errcode 、rs 为 None 。
+    """
+
+    def __init__(self, failed: typing.Dict[str, Exception]):
+        self.failed = failed
+        first = next((i for i in failed.values() if isinstance(i, WorkWeChatException)), None)
+        if first is not None:
+            super().__init__(errcode=first.errcode, errmsg=first.errmsg, rs=first.rs)
+        else:
+            super().__init__(errcode=None, errmsg="%r" % next(iter(failed.values())), rs=None)
+
+    def __str__(self) -> str:
+        return "%d users not deleted, first error: %s" % (len(self.failed), next(iter(self.failed.values())))
+
+
+class HTTPStatusError(AssertionError):
+    """接口 HTTP 状态码不是 200 ，继承 AssertionError 兼容之前 assert 的行为"""
+
+    def __init__(self, status_code: int, headers: typing.Mapping):
+        super().__init__(headers)
+        self.status_code = status_code
+        self.headers = headers
+
+
 class QrCodeSizeType(object):
     SMALL = 1  # 171x171
     MEDIUM = 2  # 399x399
@@ -79,94 +206,211 @@ MIMETYPE2WWTYPE = {
 
 DEFAULT_CONTENT_TYPE = 'file'
 
+MESSAGE_MAX_TOUSER = 1000
+MESSAGE_MAX_TOPARTY = 100
+MESSAGE_MAX_TOTAG = 100
+
+USER_BATCHDELETE_MAX = 200
+
+WEBHOOK_TEXT_MAX_BYTES = 2048
+WEBHOOK_MARKDOWN_MAX_BYTES = 4096
+WEBHOOK_IMAGE_MAX_BYTES = 2 * 1024 * 1024
+WEBHOOK_IMAGE_CACHE_SIZE = 16
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+MEDIA_EXPIRES_IN = 3 * 24 * 3600
+
+
+def _chunked(iterable: typing.Iterable, size: int) -> typing.Iterator[tuple]:
+    it = iter(iterable)
+    while True:
+        chunk = tuple(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _imap_unordered(
+        fn: typing.Callable,
+        iterable: typing.Iterable,
+        max_workers: int,
+) -> typing.Iterator[typing.Tuple[typing.Any, typing.Any]]:
+    """
+    在 max_workers 个线程中对 iterable 的元素执行 fn ，按完成顺序返回 (元素, 结果或异常)。
+    iterable 按需读取，最多 max_workers * 2 个任务在排队，调用方停止遍历时取消未开始的任务。
+    """
+    it = iter(iterable)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = dict()
+        try:
+            for item in itertools.islice(it, max_workers * 2):
+                pending[executor.submit(fn, item)] = item
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    for i in itertools.islice(it, 1):
+                        pending[executor.submit(fn, i)] = i
+                    yield item, future.exception() or future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+async def _aimap_unordered(
+        fn: typing.Callable,
+        iterable: typing.Iterable,
+        max_workers: int,
+) -> typing.AsyncIterator[typing.Tuple[typing.Any, typing.Any]]:
+    """_imap_unordered 的协程版本，fn 为协程函数，最多 max_workers 个协程同时执行"""
+    it = iter(iterable)
+    pending = dict()
+
+    def submit(item):
+        pending[asyncio.ensure_future(fn(item))] = item
+
+    try:
+        for item in itertools.islice(it, max_workers):
+            submit(item)
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = pending.pop(task)
+                for i in itertools.islice(it, 1):
+                    submit(i)
+                yield item, task.exception() or task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class BulkResult(object):
+    """批量接口中单个元素的执行结果：item 为传入的元素，成功时 result 为接口返回值，失败时 exception 为异常"""
+
+    def __init__(self, item, result=None, exception: Exception = None):
+        self.item = item
+        self.result = result
+        self.exception = exception
+
+    @property
+    def ok(self) -> bool:
+        return self.exception is None
+
+    def __repr__(self) -> str:
+        if self.ok:
+            return "BulkResult(item=%r, result=%r)" % (self.item, self.result)
+        return "BulkResult(item=%r, exception=%r)" % (self.item, self.exception)
+
 
 class NewsArticle(LikeDict):
     """ https://work.weixin.qq.com/help?doc_id=13376#图文类型 """
 
-    def __init__(self, **kwargs):
-        self.title = None
-        self.description = None
+    __slots__ = (
+        "title",
+        "description",
 
-        self.url = None
-        self.picurl = None
+        "url",
+        "picurl",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class Media(object):
-    """https://work.weixin.qq.com/api/doc/90000/90135/90253#临时媒体类型"""
+    """
+    https://work.weixin.qq.com/api/doc/90000/90135/90253#临时媒体类型
+
+    file_data 可以是文件对象（从当前位置读到结尾）、bytes 或 memoryview ；也可以只传 file_path ，上传时通过 mmap 读取。
+    """
 
-    def __init__(self, file_name: str, file_data: typing.BinaryIO):
+    def __init__(
+            self,
+            file_name: str,
+            file_data: typing.Union[typing.BinaryIO, bytes, memoryview] = None,
+            file_path: str = None,
+    ):
+        assert file_data is not None or file_path is not None
         self.file_name = file_name
         self.file_data = file_data
+        self.file_path = file_path
         self.file_type = mimetypes.guess_type(file_name)[0]
 
+    @classmethod
+    def from_path(cls, file_path: str, file_name: str = None) -> "Media":
+        return cls(file_name or os.path.basename(file_path), file_path=file_path)
+
 
 class Video(LikeDict):
     """https://work.weixin.qq.com/api/doc/90000/90135/90236#视频类型"""
 
-    def __init__(self, **kwargs):
-        self.media_id = None
-        self.title = None
-        self.description = None
+    __slots__ = (
+        "media_id",
+        "title",
+        "description",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class TaskCardBtn(LikeDict):
     """https://work.weixin.qq.com/api/doc/90000/90135/90253#按键类型"""
 
-    def __init__(self, **kwargs):
-        self.key = None
-        self.name = None
+    __slots__ = (
+        "key",
+        "name",
 
-        self.replace_name = None
-        self.color = None
-        self.is_bold = None
+        "replace_name",
+        "color",
+        "is_bold",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class TextCard(LikeDict):
     """https://work.weixin.qq.com/api/doc/90000/90135/90236#文本卡片信息"""
 
-    def __init__(self, **kwargs):
-        self.title = None
-        self.description = None
+    __slots__ = (
+        "title",
+        "description",
 
-        self.url = None
-        self.btntxt = None
+        "url",
+        "btntxt",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class TaskCard(LikeDict):
     """https://work.weixin.qq.com/api/doc/90000/90135/90236#任务卡片信息"""
 
-    def __init__(self, **kwargs):
-        self.title = None
-        self.description = None
+    __slots__ = (
+        "title",
+        "description",
 
-        self.url = None
-        self.btn = None
-        self.task_id = None
+        "url",
+        "btn",
+        "task_id",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class MpNew(LikeDict):
     """https://work.weixin.qq.com/api/doc/90000/90135/90236#图文信息(mpnews)"""
 
-    def __init__(self, **kwargs):
-        self.title = None
-        self.thumb_media_id = None
+    __slots__ = (
+        "title",
+        "thumb_media_id",
 
-        self.author = None
-        self.content_source_url = None
-        self.content = None
-        self.digest = None
+        "author",
+        "content_source_url",
+        "content",
+        "digest",
 
-        super().__init__(**kwargs)
+        "__dict__",
+    )
 
 
 class TimeType:
@@ -177,9 +421,1404 @@ class TimeType:
 mimetypes.add_type("audio/amr", ".amr")
 
 
-class WorkWeChat(object):
+class TokenBucket(object):
+    """令牌桶：每 period 秒产生 count 个令牌，最多积攒 count 个（即允许的突发请求数）。线程安全。"""
+
+    def __init__(self, count: int, period: float = 1):
+        self._rate = count / period
+        self._capacity = count
+        self._tokens = float(count)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int = 1) -> float:
+        """
+        预占令牌，返回调用方需要等待的秒数。令牌不足时预支，后来的请求按预占顺序依次排队。
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self._rate
+
+    def wait_time(self, tokens: int = 1) -> float:
+        """现在预占 tokens 个令牌需要等待的秒数，不预占"""
+        with self._lock:
+            now = time.monotonic()
+            available = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            if available >= tokens:
+                return 0
+            return (tokens - available) / self._rate
+
+    def acquire(self, tokens: int = 1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimiter(object):
+    """
+    客户端按接口限流，请求超出频率时排队等待而不是被企业微信拒绝（errcode 45009 等）：
+
+        limiter = work_wechat.RateLimiter({
+            "/message/send": (1000, 60),  # 每 60 秒最多 1000 次
+            "/appchat/send": (200, 60),
+            "/user/*": (100, 1),
+        })
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, rate_limiter=limiter)
+
+    limits 的 key 为接口 path ，支持 fnmatch 通配符，多个规则匹配时使用第一个；value 为 (次数, 秒数)。
+    同一个 RateLimiter 可以传给多个 WorkWeChat 实例，共用同一份额度。
+    注意 "/webhook/send" 按 path 限流时所有机器人 key 共用额度。
+    """
+
+    def __init__(self, limits: typing.Dict[str, typing.Tuple[int, float]]):
+        self._rules = [(pattern, TokenBucket(count=count, period=period)) for pattern, (count, period) in limits.items()]
+        self._buckets = dict()
+
+    def _get_bucket(self, path: str) -> typing.Optional[TokenBucket]:
+        try:
+            return self._buckets[path]
+        except KeyError:
+            pass
+        bucket = None
+        for pattern, i in self._rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                bucket = i
+                break
+        self._buckets[path] = bucket
+        return bucket
+
+    def reserve(self, path: str) -> float:
+        """预占 path 的一次调用额度，返回需要等待的秒数"""
+        bucket = self._get_bucket(path)
+        if bucket is None:
+            return 0
+        return bucket.reserve()
+
+
+class RetryPolicy(object):
+    """
+    请求失败自动重试：
+
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, retry_policy=work_wechat.RetryPolicy())
+
+    - 企业微信系统繁忙（errcode -1）、HTTP 5xx 、网络超时等错误，按指数退避（带随机抖动）重试；
+    - 触发频率限制（errcode 45009 等）和连接失败时，请求未被处理，所有接口都会重试；
+    - non_idempotent_paths 中的接口（发消息等）在请求可能已被处理的情况下不重试，避免重复发送；
+    - 重试预算：每次请求积攒 budget_ratio 次重试机会，最多积攒 budget_max 次，企业微信大面积故障时不会因为重试放大请求量。
+
+    access_token 失效（errcode 40014 、42001）时无论是否设置 RetryPolicy ，都会立即刷新 token 重试一次。
+    """
+
+    NON_IDEMPOTENT_PATHS = (
+        "/appchat/create",
+        "/appchat/send",
+        "/batch/invite",
+        "/message/send",
+        "/webhook/send",
+    )
+
+    def __init__(
+            self,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 10,
+            budget_ratio: float = 0.2,
+            budget_max: int = 10,
+            retry_errcodes: typing.Tuple[int, ...] = (ErrCode.ERROR,),
+            throttled_errcodes: typing.Tuple[int, ...] = (
+                    ErrCode.API_FREQ_OUT_OF_LIMIT,
+                    ErrCode.API_CONCURRENT_OUT_OF_LIMIT,
+            ),
+            retry_status_codes: typing.Tuple[int, ...] = (500, 502, 503, 504),
+            non_idempotent_paths: typing.Iterable[str] = NON_IDEMPOTENT_PATHS,
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.retry_errcodes = retry_errcodes
+        self.throttled_errcodes = throttled_errcodes
+        self.retry_status_codes = retry_status_codes
+        self.non_idempotent_paths = frozenset(non_idempotent_paths)
+
+        self._budget = float(budget_max)
+        self._lock = threading.Lock()
+
+    def is_idempotent(self, method: str, path: str) -> bool:
+        return method == "GET" or path not in self.non_idempotent_paths
+
+    def deposit(self):
+        """每次请求（不含重试）调用一次，积攒重试预算"""
+        with self._lock:
+            self._budget = min(self.budget_max, self._budget + self.budget_ratio)
+
+    def _withdraw(self) -> bool:
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            return True
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retry_delay(self, method: str, path: str, attempt: int, processed: bool) -> typing.Optional[float]:
+        """
+        第 attempt 次（从 0 开始）请求失败后，返回重试前需要等待的秒数，不重试返回 None 。
+        processed: 失败的请求是否可能已经被企业微信处理。
+        """
+        if attempt >= self.max_retries:
+            return None
+        if processed and not self.is_idempotent(method, path):
+            return None
+        if not self._withdraw():
+            return None
+        return self.backoff(attempt)
+
+
+class DirectoryCache(object):
+    """
+    通讯录缓存，减少 user_get 等读接口的网络请求：
+
+        cache = work_wechat.DirectoryCache(maxsize=10000, ttl=300)
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, directory_cache=cache)
+        ww.user_list(department_id=1, fetch_child=True)  # 加载快照
+        cache.find_by_mobile("13800000000")
+
+    - user_get 的结果按 userid 缓存，最多 maxsize 个（LRU），ttl 秒后过期；
+    - user_list 的结果作为快照保存 snapshot_ttl 秒，按部门、手机号、邮箱、姓名建立索引，user_get 未命中时也会查快照；
+    - 通过同一个 WorkWeChat 调用 user_update 、user_delete 、user_batchdelete 成功后，自动更新或删除缓存中的成员。
+
+    返回的成员信息是缓存的浅拷贝。线程安全。
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, snapshot_ttl: float = 3600):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._snapshot_ttl = snapshot_ttl
+
+        self._lock = threading.RLock()
+        self._users = collections.OrderedDict()
+        self._snapshot = dict()
+        self._by_department = collections.defaultdict(set)
+        self._by_mobile = dict()
+        self._by_email = dict()
+        self._by_name = collections.defaultdict(set)
+
+    def get(self, userid: str) -> typing.Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._users.get(userid)
+            if item is not None:
+                expires_at, user = item
+                if expires_at > now:
+                    self._users.move_to_end(userid)
+                    return dict(user)
+                del self._users[userid]
+            return self._get_snapshot(userid, now)
+
+    def put(self, user: dict):
+        with self._lock:
+            self._users[user["userid"]] = (time.monotonic() + self._ttl, dict(user))
+            self._users.move_to_end(user["userid"])
+            while len(self._users) > self._maxsize:
+                self._users.popitem(last=False)
+
+    def put_snapshot(self, users: typing.Iterable[dict]):
+        expires_at = time.monotonic() + self._snapshot_ttl
+        with self._lock:
+            for user in users:
+                user = dict(user)
+                self._unindex(user["userid"])
+                self._snapshot[user["userid"]] = (expires_at, user)
+                self._index(user)
+
+    def patch(self, userid: str, fields: dict):
+        """user_update 成功后把修改的字段合并到缓存的成员信息"""
+        with self._lock:
+            item = self._users.get(userid)
+            if item is not None:
+                user = dict(item[1])
+                user.update(fields)
+                self._users[userid] = (item[0], user)
+            item = self._snapshot.get(userid)
+            if item is not None:
+                user = dict(item[1])
+                user.update(fields)
+                self._unindex(userid)
+                self._snapshot[userid] = (item[0], user)
+                self._index(user)
+
+    def evict(self, userid: str):
+        with self._lock:
+            self._users.pop(userid, None)
+            self._unindex(userid)
+            self._snapshot.pop(userid, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._snapshot.clear()
+            self._by_department.clear()
+            self._by_mobile.clear()
+            self._by_email.clear()
+            self._by_name.clear()
+
+    def find_by_department(self, department_id: int) -> typing.List[dict]:
+        """快照中部门 department_id 下的成员（不含子部门）"""
+        with self._lock:
+            return self._get_snapshot_many(self._by_department.get(department_id, ()))
+
+    def find_by_mobile(self, mobile: str) -> typing.Optional[dict]:
+        with self._lock:
+            return self._get_snapshot(self._by_mobile.get(mobile), time.monotonic())
+
+    def find_by_email(self, email: str) -> typing.Optional[dict]:
+        with self._lock:
+            return self._get_snapshot(self._by_email.get(email.lower()), time.monotonic())
+
+    def find_by_name(self, name: str) -> typing.List[dict]:
+        with self._lock:
+            return self._get_snapshot_many(self._by_name.get(name, ()))
+
+    def _get_snapshot(self, userid: typing.Optional[str], now: float) -> typing.Optional[dict]:
+        item = self._snapshot.get(userid)
+        if item is None:
+            return None
+        expires_at, user = item
+        if expires_at <= now:
+            self._unindex(userid)
+            del self._snapshot[userid]
+            return None
+        return dict(user)
+
+    def _get_snapshot_many(self, userids: typing.Iterable[str]) -> typing.List[dict]:
+        now = time.monotonic()
+        users = [self._get_snapshot(i, now) for i in list(userids)]
+        return [i for i in users if i is not None]
+
+    def _index(self, user: dict):
+        userid = user["userid"]
+        for i in user.get("department") or ():
+            self._by_department[i].add(userid)
+        if user.get("mobile"):
+            self._by_mobile[user["mobile"]] = userid
+        if user.get("email"):
+            self._by_email[user["email"].lower()] = userid
+        if user.get("name"):
+            self._by_name[user["name"]].add(userid)
+
+    def _unindex(self, userid: str):
+        item = self._snapshot.get(userid)
+        if item is None:
+            return
+        user = item[1]
+        for i in user.get("department") or ():
+            self._by_department[i].discard(userid)
+            if not self._by_department[i]:
+                del self._by_department[i]
+        if user.get("mobile") and self._by_mobile.get(user["mobile"]) == userid:
+            del self._by_mobile[user["mobile"]]
+        if user.get("email") and self._by_email.get(user["email"].lower()) == userid:
+            del self._by_email[user["email"].lower()]
+        if user.get("name"):
+            self._by_name[user["name"]].discard(userid)
+            if not self._by_name[user["name"]]:
+                del self._by_name[user["name"]]
+
+
+class ResponseCache(object):
+    """
+    读接口响应缓存，变化很少的接口在有效期内直接返回缓存的响应，不再请求网络：
+
+        cache = work_wechat.ResponseCache(ttls={"/agent/get": 600}, maxsize=1024)
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, response_cache=cache)
+        ww.agent_get(agentid)
+        cache.stats()  # {"/agent/get": {"hits": 0, "misses": 1}}
+
+    - ttls 为 {path: 有效期秒数} ，与 DEFAULT_TTLS 合并，有效期为 0 或 None 的接口不缓存；
+    - 按 corpid 、corpsecret 和请求参数缓存，只缓存 errcode 为 0 的响应，最多 maxsize 个（LRU）；
+    - 通过同一个 WorkWeChat 调用 INVALIDATES 中的修改接口成功后（比如 appchat_update ），删除对应的缓存。
+
+    返回的响应是缓存的拷贝，修改返回值不影响缓存。线程安全。
+    """
+
+    DEFAULT_TTLS = {
+        "/agent/get": 300,
+        "/appchat/get": 60,
+        "/corp/get_join_qrcode": 3600,
+        "/get_api_domain_ip": 600,
+    }
+
+    # 修改接口 path: (受影响的读接口 path, 用于定位缓存的参数名)
+    INVALIDATES = {
+        "/appchat/update": ("/appchat/get", ("chatid",)),
+    }
+
+    def __init__(self, ttls: typing.Dict[str, float] = None, maxsize: int = 1024):
+        self._ttls = dict(self.DEFAULT_TTLS)
+        self._ttls.update(ttls or ())
+        self._maxsize = maxsize
+
+        self._lock = threading.Lock()
+        self._responses = collections.OrderedDict()
+        self._hits = collections.Counter()
+        self._misses = collections.Counter()
+
+    @staticmethod
+    def _key(namespace: str, path: str, params: typing.Iterable[typing.Tuple[str, typing.Any]]) -> tuple:
+        return namespace, path, tuple(sorted((k, "%s" % v) for k, v in params))
+
+    def lookup(
+            self,
+            namespace: str,
+            path: str,
+            params_qs: dict = None,
+            params_post: dict = None,
+    ) -> typing.Tuple[typing.Optional[tuple], typing.Optional[dict]]:
+        """返回 (缓存 key, 缓存的响应)，不缓存的接口 key 为 None ，未命中时响应为 None"""
+        if not self._ttls.get(path):
+            return None, None
+        params = itertools.chain((params_qs or {}).items(), (params_post or {}).items())
+        key = self._key(namespace, path, params)
+        now = time.monotonic()
+        with self._lock:
+            item = self._responses.get(key)
+            if item is not None:
+                expires_at, rs = item
+                if expires_at > now:
+                    self._responses.move_to_end(key)
+                    self._hits[path] += 1
+                    return key, copy.deepcopy(rs)
+                del self._responses[key]
+            self._misses[path] += 1
+        return key, None
+
+    def store(self, key: typing.Optional[tuple], rs: dict):
+        if key is None or rs.get("errcode", 0) != ErrCode.SUCCESS:
+            return
+        with self._lock:
+            self._responses[key] = (time.monotonic() + self._ttls[key[1]], copy.deepcopy(rs))
+            self._responses.move_to_end(key)
+            while len(self._responses) > self._maxsize:
+                self._responses.popitem(last=False)
+
+    def invalidate(self, namespace: str, path: str, params_qs: dict = None, params_post: dict = None):
+        """path 为修改接口时，删除受影响的读接口缓存"""
+        rule = self.INVALIDATES.get(path)
+        if rule is None:
+            return
+        path_cached, fields = rule
+        params = dict(params_qs or {})
+        params.update(params_post or {})
+        key = self._key(namespace, path_cached, ((i, params[i]) for i in fields if i in params))
+        with self._lock:
+            self._responses.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """各接口的命中、未命中次数"""
+        with self._lock:
+            return dict(
+                (path, dict(hits=self._hits[path], misses=self._misses[path]))
+                for path in set(self._hits) | set(self._misses)
+            )
+
+
+class Metrics(object):
+    """
+    请求指标，记录各接口的耗时分布、按 errcode 统计的请求数与失败数、重试次数、并发中的请求数和 token 刷新次数：
+
+        metrics = work_wechat.Metrics()
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, metrics=metrics)
+        ww.user_get(userid)
+        metrics.snapshot()  # {"requests": {"/user/get": {"0": 1}}, ...}
+        metrics.to_prometheus()  # Prometheus 文本格式，可以直接作为 /metrics 的响应
+
+    每次请求（包括重试）的耗时拆分为 PHASES 中的几个阶段：
+    token 获取 access_token（包括刷新）、throttle 等待 rate_limiter 、encode 组装 URL 和请求体、
+    http 连接、上传与等待服务端响应、decode 解析响应 JSON 。
+
+    不传 metrics 时不记录任何指标。线程安全。
+    """
+
+    PHASES = ("token", "throttle", "encode", "http", "decode")
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS, prefix: str = "work_wechat"):
+        self._buckets = tuple(sorted(buckets))
+        self._prefix = prefix
+
+        self._lock = threading.Lock()
+        self._latency = dict()  # path: [各桶计数..., +Inf 计数]
+        self._latency_sum = collections.Counter()
+        self._phases = collections.Counter()  # (path, phase): 秒数
+        self._requests = collections.Counter()  # (path, errcode): 次数
+        self._errors = collections.Counter()
+        self._retries = collections.Counter()
+        self._in_flight = collections.Counter()
+        self._token_refreshes = 0
+
+    @staticmethod
+    def errcode_of(rs: typing.Optional[dict], ex: typing.Optional[Exception]) -> str:
+        """请求结果的 errcode 标签：接口返回的 errcode ， HTTP 状态码错误为 http_<状态码>，其他异常为异常类名"""
+        if ex is None:
+            return "%s" % rs.get("errcode", ErrCode.SUCCESS)
+        if isinstance(ex, WorkWeChatException):
+            return "%s" % ex.errcode
+        if isinstance(ex, HTTPStatusError):
+            return "http_%s" % ex.status_code
+        return type(ex).__name__
+
+    def request_started(self, path: str):
+        with self._lock:
+            self._in_flight[path] += 1
+
+    def request_finished(self, path: str, timings: typing.Dict[str, float], errcode: str, error: bool = None):
+        """
+        timings 为 {阶段: 秒数, "total": 秒数}；
+        error 表示请求是否失败，为 None 时 errcode 不为 "0" 即计为失败（接口接受的 errcode 如 60111 应传 False）
+        """
+        total = timings["total"]
+        i = bisect.bisect_left(self._buckets, total)
+        with self._lock:
+            self._in_flight[path] -= 1
+            counts = self._latency.get(path)
+            if counts is None:
+                counts = self._latency[path] = [0] * (len(self._buckets) + 1)
+            counts[i] += 1
+            self._latency_sum[path] += total
+            for phase in self.PHASES:
+                if phase in timings:
+                    self._phases[path, phase] += timings[phase]
+            self._requests[path, errcode] += 1
+            if error or (error is None and errcode != "0"):
+                self._errors[path, errcode] += 1
+
+    def request_retried(self, path: str):
+        with self._lock:
+            self._retries[path] += 1
+
+    def token_refreshed(self):
+        with self._lock:
+            self._token_refreshes += 1
+
+    def reset(self):
+        """清空所有指标，并发中的请求数除外"""
+        with self._lock:
+            self._latency.clear()
+            self._latency_sum.clear()
+            self._phases.clear()
+            self._requests.clear()
+            self._errors.clear()
+            self._retries.clear()
+            self._token_refreshes = 0
+
+    @staticmethod
+    def _nested(counter: collections.Counter) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        rs = dict()
+        for (path, label), v in counter.items():
+            rs.setdefault(path, dict())[label] = v
+        return rs
+
+    def snapshot(self) -> dict:
+        """
+        返回当前指标的拷贝：
+
+            {
+                "requests": {path: {errcode: 次数}},
+                "errors": {path: {errcode: 次数}},
+                "latency": {path: {"count": 次数, "sum": 秒数, "buckets": {上界: 累计次数}}},
+                "phases": {path: {阶段: 秒数}},
+                "retries": {path: 次数},
+                "in_flight": {path: 并发中的请求数},
+                "token_refreshes": 次数,
+            }
+        """
+        with self._lock:
+            latency = dict()
+            for path, counts in self._latency.items():
+                cumulative = list(itertools.accumulate(counts))
+                latency[path] = dict(
+                    count=cumulative[-1],
+                    sum=self._latency_sum[path],
+                    buckets=dict(zip(self._buckets + (float("inf"),), cumulative)),
+                )
+            return dict(
+                requests=self._nested(self._requests),
+                errors=self._nested(self._errors),
+                latency=latency,
+                phases=self._nested(self._phases),
+                retries=dict(self._retries),
+                in_flight=dict((path, n) for path, n in self._in_flight.items() if n),
+                token_refreshes=self._token_refreshes,
+            )
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        def escape(v):
+            return ("%s" % v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        return "{%s}" % ",".join('%s="%s"' % (k, escape(v)) for k, v in labels.items())
+
+    @staticmethod
+    def _float(v: float) -> str:
+        return "+Inf" if v == float("inf") else repr(float(v))
+
+    def to_prometheus(self) -> str:
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        snapshot = self.snapshot()
+        name = self._prefix + "_"
+        lines = []
+
+        def metric(metric_name, metric_type, help_text, samples):
+            lines.append("# HELP %s%s %s" % (name, metric_name, help_text))
+            lines.append("# TYPE %s%s %s" % (name, metric_name, metric_type))
+            for suffix, labels, v in samples:
+                lines.append("%s%s%s%s %s" % (name, metric_name, suffix, labels, v))
+
+        metric("request_duration_seconds", "histogram", "Request latency by API path.", [
+            sample
+            for path, h in sorted(snapshot["latency"].items())
+            for sample in itertools.chain(
+                (("_bucket", self._labels(path=path, le=self._float(le)), n) for le, n in h["buckets"].items()),
+                (("_sum", self._labels(path=path), self._float(h["sum"])),
+                 ("_count", self._labels(path=path), h["count"])),
+            )
+        ])
+        metric("request_phase_seconds_total", "counter", "Time spent in each request phase by API path.", [
+            ("", self._labels(path=path, phase=phase), self._float(v))
+            for path, phases in sorted(snapshot["phases"].items())
+            for phase, v in sorted(phases.items())
+        ])
+        for metric_name, help_text in (
+                ("requests_total", "Requests by API path and errcode."),
+                ("errors_total", "Failed requests by API path and errcode."),
+        ):
+            metric(metric_name, "counter", help_text, [
+                ("", self._labels(path=path, errcode=errcode), n)
+                for path, counts in sorted(snapshot[metric_name[:-len("_total")]].items())
+                for errcode, n in sorted(counts.items())
+            ])
+        metric("retries_total", "counter", "Retried requests by API path.", [
+            ("", self._labels(path=path), n) for path, n in sorted(snapshot["retries"].items())
+        ])
+        metric("requests_in_flight", "gauge", "Requests in flight by API path.", [
+            ("", self._labels(path=path), n) for path, n in sorted(snapshot["in_flight"].items())
+        ])
+        metric("token_refreshes_total", "counter", "Access token refreshes.", [
+            ("", "", snapshot["token_refreshes"]),
+        ])
+        return "\n".join(lines) + "\n"
+
+
+class RequestInfo(object):
+    """
+    传给 RequestHooks 的一次请求，重试时是新的 RequestInfo ：
+
+    - method 、path 、params_post 为请求参数，不要修改；
+    - attempt 为同一次调用中的第几次请求（从 0 开始）；
+    - timings 在请求结束后为各阶段耗时 {阶段: 秒数, "total": 秒数}（阶段见 Metrics.PHASES ），统计了 CPU 时间的请求还有 "cpu" ；
+    - profile 在 before_request 中设为 True 时统计这次请求在调用线程上消耗的 CPU 时间；
+    - context 供 hooks 保存自己的状态，比如 tracing span 。
+    """
+
+    def __init__(self, method: str, path: str, params_post: dict = None, attempt: int = 0):
+        self.method = method
+        self.path = path
+        self.params_post = params_post
+        self.attempt = attempt
+        self.profile = False
+        self.timings = None
+        self.context = dict()
+        self.marks = None
+
+    def __repr__(self) -> str:
+        return "RequestInfo(method=%r, path=%r, attempt=%r)" % (self.method, self.path, self.attempt)
+
+
+class RequestHooks(object):
+    """
+    请求钩子，继承并覆盖需要的方法，通过 WorkWeChat 的 hooks 参数传入，比如接入 tracing ：
+
+        class TracingHooks(work_wechat.RequestHooks):
+            def before_request(self, request):
+                request.context["span"] = tracer.start_span(request.path)
+
+            def after_response(self, request, rs):
+                request.context["span"].finish(tags=request.timings)
+
+            def on_error(self, request, ex):
+                request.context["span"].finish(error=ex, tags=request.timings)
+
+    多个 hooks 按洋葱模型调用：before_request 按传入顺序，after_response 、on_error 按相反顺序。
+    每次请求（包括重试）都会调用，命中 ResponseCache 的请求不调用。
+    钩子抛出的异常只记录日志，不影响请求；钩子在发出请求的线程（或事件循环）中同步执行，不应阻塞。
+    """
+
+    def before_request(self, request: RequestInfo):
+        pass
+
+    def after_response(self, request: RequestInfo, rs: dict):
+        """请求成功，rs 为接口响应"""
+        pass
+
+    def on_error(self, request: RequestInfo, ex: Exception):
+        """请求失败（包括 errcode 不为 0），之后可能还会重试"""
+        pass
+
+    def on_retry(self, request: RequestInfo, ex: Exception, delay: float):
+        """request 失败后将在 delay 秒后重试"""
+        pass
+
+
+class RequestProfiler(RequestHooks):
+    """
+    抽样分析各接口的耗时，区分 SDK 自身消耗的 CPU 时间和等待的时间：
+
+        profiler = work_wechat.RequestProfiler(sample_rate=0.01)
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, hooks=[profiler])
+        ...
+        profiler.report()  # {"/user/list": {"count": 12, "wall": 0.9, "cpu": 0.3, "wait": 0.6}}
+
+    cpu 为请求过程中调用线程消耗的 CPU 时间（组装请求、序列化、解析 JSON 、HTTP 库内部处理等），
+    wait 为其余时间（网络、服务端处理、限流等待等）。
+    AsyncWorkWeChat 只统计不会切换协程的 encode 、decode 阶段的 CPU 时间，避免计入同时运行的其他协程；
+    iter_user_list 等流式接口的 decode 阶段边下载边解析，其中的 CPU 时间仍可能包含其他协程。
+    Python 3.6 没有线程 CPU 时间，统计的是整个进程的 CPU 时间，多线程并发时偏大。
+    """
+
+    def __init__(self, sample_rate: float = 0.01):
+        self._sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._stats = dict()  # path: [count, wall, cpu]
+
+    def before_request(self, request: RequestInfo):
+        if random.random() < self._sample_rate:
+            request.profile = True
+
+    def _record(self, request: RequestInfo):
+        if not request.profile:
+            return
+        timings = request.timings
+        with self._lock:
+            stats = self._stats.get(request.path)
+            if stats is None:
+                stats = self._stats[request.path] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += timings["total"]
+            stats[2] += timings["cpu"]
+
+    def after_response(self, request: RequestInfo, rs: dict):
+        self._record(request)
+
+    def on_error(self, request: RequestInfo, ex: Exception):
+        self._record(request)
+
+    def report(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """各接口抽样请求的次数和累计的总耗时、CPU 时间、等待时间（秒）"""
+        with self._lock:
+            return dict(
+                (path, dict(count=count, wall=wall, cpu=cpu, wait=max(wall - cpu, 0.0)))
+                for path, (count, wall, cpu) in self._stats.items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+# Python 3.6 没有 time.thread_time ，退回到整个进程的 CPU 时间
+_thread_time = getattr(time, "thread_time", time.process_time)
+
+
+class _ProfiledMarks(list):
+    """记录各阶段结束时间的同时记录调用线程的 CPU 时间"""
+
+    def __init__(self):
+        super().__init__()
+        self.cpu = []
+
+    def append(self, t: float):
+        super().append(t)
+        self.cpu.append(_thread_time())
+
+
+_INCOMPLETE = object()
+
+
+class _JsonArrayStream(object):
+    """
+    增量解析 {"errcode": 0, "errmsg": "ok", "userlist": [{...}, {...}]} 形式的响应：
+    feed() 传入一段响应数据，返回其中已经完整的数组元素；finish() 返回数组以外的字段。
+    内存占用只和单个数组元素的大小有关，和数组长度无关。
+    """
+
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, field: str):
+        self._field = field
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._state = "start"
+        self._key = None
+        self.envelope = dict()
+
+    def feed(self, data: bytes) -> list:
+        self._buf += self._utf8.decode(data)
+        return self._parse(final=False)
+
+    def finish(self) -> dict:
+        self._buf += self._utf8.decode(b"", final=True)
+        self._parse(final=True)
+        if self._state != "done":
+            raise ValueError("incomplete JSON response")
+        return self.envelope
+
+    def _decode(self, buf: str, pos: int, final: bool):
+        try:
+            value, end = self._decoder.raw_decode(buf, pos)
+        except ValueError:
+            if final:
+                raise
+            return _INCOMPLETE, pos
+        if end >= len(buf) and not final:
+            # 数字等值可能被截断在数据末尾，等下一段数据再解析
+            return _INCOMPLETE, pos
+        return value, end
+
+    def _expect(self, c: str, expected: str):
+        if c not in expected:
+            raise ValueError("unexpected %r in JSON response, expected %r" % (c, expected))
+
+    def _parse(self, final: bool) -> list:
+        items = []
+        buf, pos = self._buf, 0
+        while True:
+            pos = self._WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            c = buf[pos]
+            state = self._state
+            if state == "done":
+                raise ValueError("extra data in JSON response")
+            elif state == "start":
+                self._expect(c, "{")
+                pos += 1
+                self._state = "key_or_end"
+            elif state == "key_or_end" and c == "}":
+                pos += 1
+                self._state = "done"
+            elif state in ("key_or_end", "key"):
+                self._key, pos_end = self._decode(buf, pos, final)
+                if self._key is _INCOMPLETE:
+                    break
+                pos = pos_end
+                self._state = "colon"
+            elif state == "colon":
+                self._expect(c, ":")
+                pos += 1
+                self._state = "value"
+            elif state == "value" and self._key == self._field:
+                self._expect(c, "[")
+                pos += 1
+                self._state = "item_or_end"
+            elif state == "value":
+                value, pos_end = self._decode(buf, pos, final)
+                if value is _INCOMPLETE:
+                    break
+                self.envelope[self._key] = value
+                pos = pos_end
+                self._state = "object_sep"
+            elif state == "item_or_end" and c == "]":
+                pos += 1
+                self._state = "object_sep"
+            elif state in ("item_or_end", "item"):
+                value, pos_end = self._decode(buf, pos, final)
+                if value is _INCOMPLETE:
+                    break
+                items.append(value)
+                pos = pos_end
+                self._state = "item_sep"
+            elif state == "item_sep":
+                self._expect(c, ",]")
+                pos += 1
+                self._state = "item" if c == "," else "object_sep"
+            elif state == "object_sep":
+                self._expect(c, ",}")
+                pos += 1
+                self._state = "key" if c == "," else "done"
+        self._buf = buf[pos:]
+        return items
+
+
+class _MultipartStream(object):
+    """
+    流式 multipart/form-data 请求体，读取时按需从各个文件读取，不在内存中拼接整个请求体，
+    内存占用只和每次读取的块大小有关，和文件大小无关；请求体长度预先计算，作为 Content-Length 发送。
+
+    文件内容可以是 bytes 、memoryview 、文件对象（从当前位置读到结尾）或文件路径（ os.PathLike ，通过 mmap 读取）。
+    """
+
+    def __init__(self, files: typing.Dict[str, typing.Tuple[str, typing.Any, str]]):
+        self.boundary = os.urandom(16).hex()
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+
+        self._parts = []
+        self._offsets = []
+        self._size = 0
+        self._pos = 0
+        self._maps = []
+
+        for name, (file_name, file_data, file_type) in files.items():
+            read_at, size = self._open(file_data)
+            header = (
+                '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"; filelength=%d\r\n'
+                'Content-Type: %s\r\n\r\n'
+                % (self.boundary, self._quote(name), self._quote(file_name), size,
+                   file_type or "application/octet-stream")
+            ).encode("utf8")
+            self._add(self._bytes_reader(header), len(header))
+            self._add(read_at, size)
+            self._add(self._bytes_reader(b"\r\n"), 2)
+        closing = ("--%s--\r\n" % self.boundary).encode("utf8")
+        self._add(self._bytes_reader(closing), len(closing))
+
+    @staticmethod
+    def _quote(value: str) -> str:
+        # 与浏览器一致：引号、换行按百分号编码，其他字符保持 UTF-8 原文
+        return value.replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+
+    @staticmethod
+    def _bytes_reader(data: typing.Union[bytes, memoryview]) -> typing.Callable[[int, int], bytes]:
+        view = memoryview(data).cast("B")
+        return lambda offset, size: bytes(view[offset:offset + size])
+
+    def _open(self, file_data) -> typing.Tuple[typing.Callable[[int, int], bytes], int]:
+        if isinstance(file_data, (bytes, bytearray, memoryview)):
+            view = memoryview(file_data).cast("B")
+            return self._bytes_reader(view), view.nbytes
+
+        if isinstance(file_data, os.PathLike):
+            with open(file_data, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    # 空文件不能 mmap
+                    return self._bytes_reader(b""), 0
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(m)
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            released = [0]
+
+            def read_at(offset: int, n: int) -> bytes:
+                chunk = m[offset:offset + n]
+                # 已经发送的部分不再占用进程内存（ RSS ）
+                end = offset // mmap.PAGESIZE * mmap.PAGESIZE
+                if end > released[0] and hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_DONTNEED, released[0], end - released[0])
+                    released[0] = end
+                return chunk
+
+            return read_at, size
+
+        seekable = getattr(file_data, "seekable", None)
+        if seekable is None or not seekable():
+            # 无法预先知道长度的流只能整个读入内存
+            return self._open(file_data.read())
+        start = file_data.tell()
+        size = file_data.seek(0, os.SEEK_END) - start
+        file_data.seek(start)
+
+        def read_at(offset: int, n: int) -> bytes:
+            file_data.seek(start + offset)
+            return file_data.read(n)
+
+        return read_at, size
+
+    def _add(self, read_at: typing.Callable[[int, int], bytes], size: int):
+        if size == 0:
+            return
+        self._parts.append(read_at)
+        self._offsets.append(self._size)
+        self._size += size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = max(0, min(offset, self._size))
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        """读取最多 size 个字节，跨越文件边界时只读到当前文件结尾"""
+        if self._pos >= self._size:
+            return b""
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(STREAM_CHUNK_SIZE), b""))
+        i = bisect.bisect_right(self._offsets, self._pos) - 1
+        part_end = self._offsets[i + 1] if i + 1 < len(self._offsets) else self._size
+        n = min(size, part_end - self._pos)
+        chunk = self._parts[i](self._pos - self._offsets[i], n)
+        self._pos += len(chunk)
+        return chunk
+
+    def close(self):
+        for m in self._maps:
+            m.close()
+        self._maps = []
+
+
+def _media_digest(file_data: typing.Union[typing.BinaryIO, bytes, memoryview, os.PathLike]) -> str:
+    """文件内容的 sha256 ，文件对象从当前位置读到结尾，读完后回到原来的位置"""
+    h = hashlib.sha256()
+    if isinstance(file_data, (bytes, bytearray, memoryview)):
+        h.update(file_data)
+    elif isinstance(file_data, os.PathLike):
+        with open(file_data, "rb") as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                h.update(chunk)
+    else:
+        start = file_data.tell()
+        for chunk in iter(lambda: file_data.read(STREAM_CHUNK_SIZE), b""):
+            h.update(chunk)
+        file_data.seek(start)
+    return h.hexdigest()
+
+
+def _encode_image(data: typing.Union[bytes, memoryview, mmap.mmap]) -> typing.Tuple[str, str]:
+    """一次遍历同时计算 base64 和 md5 ：按 3 字节的整数倍分块，各块的 base64 直接拼接，不复制原始数据"""
+    md5 = hashlib.md5()
+    parts = []
+    step = 3 * STREAM_CHUNK_SIZE
+    with memoryview(data) as view:
+        with view.cast("B") as view:
+            for i in range(0, view.nbytes, step):
+                with view[i:i + step] as chunk:
+                    md5.update(chunk)
+                    parts.append(binascii.b2a_base64(chunk, newline=False))
+    return b"".join(parts).decode("ascii"), md5.hexdigest()
+
+
+class _NullLock(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+def _json_default(obj):
+    if isinstance(obj, LikeDict):
+        return obj.to_dict(drop_none=True)
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+class JsonCodec(object):
+    """
+    请求体序列化、响应反序列化接口，可以通过 WorkWeChat 的 json_codec 参数替换。
+    默认安装了 orjson 时使用 OrjsonCodec ，否则使用标准库 json 。
+    """
+
+    def dumps(self, obj) -> typing.Union[str, bytes]:
+        return json.dumps(obj, default=_json_default)
+
+    def loads(self, data: typing.Union[str, bytes]):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """基于 orjson ，序列化、反序列化都比标准库快数倍，请求体为 UTF-8 编码（标准库转义为 \\uXXXX ）"""
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("OrjsonCodec requires orjson, install it by `pip install orjson`")
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, default=_json_default)
+
+    def loads(self, data: typing.Union[str, bytes]):
+        return orjson.loads(data)
+
+
+def default_json_codec() -> JsonCodec:
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+class TokenStore(object):
+    """
+    access_token 存储接口，多个进程或多台机器共用一个 token 时，实现该接口（比如基于 Redis）并传给 WorkWeChat 的 token_store 参数。
+    key 由 corpid 和 corpsecret 生成，不同应用的 token 互不影响。
+    """
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[str, int]]:
+        """返回 (access_token, 过期时间戳)，不存在返回 None"""
+        raise NotImplementedError
+
+    def set(self, key: str, access_token: str, expires_at: int):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def lock(self, key: str) -> typing.ContextManager:
+        """刷新 token 期间持有的锁，跨进程共享的存储应实现为跨进程锁，避免多个进程同时调用 /gettoken ；默认不加锁。"""
+        return _NullLock()
+
+
+class MemoryTokenStore(TokenStore):
+    """进程内存储，WorkWeChat 默认使用。"""
+
+    def __init__(self):
+        self._tokens = dict()
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[str, int]]:
+        return self._tokens.get(key)
+
+    def set(self, key: str, access_token: str, expires_at: int):
+        self._tokens[key] = (access_token, expires_at)
+
+    def delete(self, key: str):
+        self._tokens.pop(key, None)
+
+
+class _FileLock(object):
+    def __init__(self, path: str):
+        self._path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FileTokenStore(TokenStore):
+    """
+    基于本地文件的存储，同一台机器上的多个进程（gunicorn worker、crontab 脚本等）共用一个 token ：
+
+        store = work_wechat.FileTokenStore("/tmp/work_wechat_token.json")
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, token_store=store)
+
+    写入时先写临时文件再原子替换，读取不需要加锁；刷新 token 时持有 path + ".lock" 文件锁。
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock_path = path + ".lock"
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def _dump(self, tokens: dict):
+        path_tmp = "%s.%d.tmp" % (self._path, os.getpid())
+        fd = os.open(path_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(path_tmp, self._path)
+
+    def get(self, key: str) -> typing.Optional[typing.Tuple[str, int]]:
+        token = self._load().get(key)
+        if not token:
+            return None
+        return token["access_token"], token["expires_at"]
+
+    def set(self, key: str, access_token: str, expires_at: int):
+        with _FileLock(self._lock_path + ".w"):
+            now = int(time.time())
+            tokens = dict((k, v) for k, v in self._load().items() if v["expires_at"] > now)
+            tokens[key] = dict(access_token=access_token, expires_at=expires_at)
+            self._dump(tokens)
+
+    def delete(self, key: str):
+        with _FileLock(self._lock_path + ".w"):
+            tokens = self._load()
+            if tokens.pop(key, None) is not None:
+                self._dump(tokens)
+
+    def lock(self, key: str) -> typing.ContextManager:
+        return _FileLock(self._lock_path)
+
+
+class IdCache(object):
+    """
+    ID 转换结果缓存接口，userid 与 openid 、手机号与 hashcode 的对应关系不会变化，缓存后不再请求接口。
+    namespace 为 corpid ，kind 为转换类型（ openid 、userid 、mobile_hashcode:<state> ），不同企业、不同类型互不影响。
+    """
+
+    def get_many(self, namespace: str, kind: str, keys: typing.Iterable[str]) -> typing.Dict[str, str]:
+        """返回已缓存的 {key: value} ，未缓存的 key 不在结果中"""
+        raise NotImplementedError
+
+    def set_many(self, namespace: str, kind: str, mapping: typing.Dict[str, str]):
+        raise NotImplementedError
+
+
+class MemoryIdCache(IdCache):
+    """进程内缓存，不限数量，进程退出后丢失。"""
+
+    def __init__(self):
+        self._values = dict()
+
+    def get_many(self, namespace: str, kind: str, keys: typing.Iterable[str]) -> typing.Dict[str, str]:
+        values = self._values.get((namespace, kind), {})
+        return dict((k, values[k]) for k in keys if k in values)
+
+    def set_many(self, namespace: str, kind: str, mapping: typing.Dict[str, str]):
+        self._values.setdefault((namespace, kind), {}).update(mapping)
+
+
+class SqliteIdCache(IdCache):
+    """
+    基于 SQLite 的持久化缓存，重启后仍然有效，同一台机器上的多个进程可以共用一个文件：
+
+        cache = work_wechat.SqliteIdCache("/var/lib/app/work_wechat_ids.db")
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, id_cache=cache)
+        ww.user_batch_convert_to_openid(userids)
+
+    使用 WAL 模式，读写不互相阻塞。线程安全。
+    """
+
+    # 旧版本 SQLite 单条语句最多 999 个参数
+    _MAX_VARIABLES = 500
+
+    def __init__(self, path: str, timeout: float = 30):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS id_cache ("
+                "namespace TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, kind, key)) WITHOUT ROWID"
+            )
+
+    def get_many(self, namespace: str, kind: str, keys: typing.Iterable[str]) -> typing.Dict[str, str]:
+        values = dict()
+        with self._lock:
+            for chunk in _chunked(keys, self._MAX_VARIABLES):
+                rows = self._conn.execute(
+                    "SELECT key, value FROM id_cache WHERE namespace = ? AND kind = ? AND key IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    (namespace, kind) + chunk,
+                )
+                values.update(rows)
+        return values
+
+    def set_many(self, namespace: str, kind: str, mapping: typing.Dict[str, str]):
+        if not mapping:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO id_cache (namespace, kind, key, value) VALUES (?, ?, ?, ?)",
+                    ((namespace, kind, k, v) for k, v in mapping.items()),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MediaCache(object):
+    """
+    临时素材 media_id 缓存，按文件内容的 sha256 和素材类型缓存，相同的文件在有效期内不再重复上传：
+
+        cache = work_wechat.MediaCache("/var/lib/app/work_wechat_media.db")
+        ww = work_wechat.WorkWeChat(corpid=corpid, corpsecret=corpsecret, media_cache=cache)
+        ww.media_upload(work_wechat.Media.from_path("logo.png"))  # 3 天内再次上传同一个文件直接返回缓存的 media_id
+
+    - 临时素材 3 天后失效，剩余有效期不足 min_ttl 秒的 media_id 视为失效，重新上传；
+    - 保存在 SQLite 文件中，重启后仍然有效，同一台机器上的多个进程可以共用一个文件；默认 ":memory:" 只在进程内有效。
+
+    线程安全。
+    """
+
+    def __init__(self, path: str = ":memory:", min_ttl: float = 3600, timeout: float = 30):
+        self._min_ttl = min_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_cache ("
+                "namespace TEXT NOT NULL, type TEXT NOT NULL, digest TEXT NOT NULL, "
+                "media_id TEXT NOT NULL, expires_at INTEGER NOT NULL, "
+                "PRIMARY KEY (namespace, type, digest)) WITHOUT ROWID"
+            )
+
+    def get(self, namespace: str, media_type: str, digest: str) -> typing.Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT media_id FROM media_cache WHERE namespace = ? AND type = ? AND digest = ? AND expires_at > ?",
+                (namespace, media_type, digest, time.time() + self._min_ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, namespace: str, media_type: str, digest: str, media_id: str, expires_at: int):
+        with self._lock:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO media_cache (namespace, type, digest, media_id, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (namespace, media_type, digest, media_id, expires_at),
+                )
+                self._conn.execute("DELETE FROM media_cache WHERE expires_at <= ?", (int(time.time()),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MessageTemplate(object):
+    """
+    预先序列化的应用消息模板，给大量成员发送个性化消息时，每个接收人只替换变量，不再重复组装、序列化整个请求：
+
+        template = work_wechat.MessageTemplate(
+            msgtype=work_wechat.MsgType.TEXTCARD,
+            agentid=agentid,
+            textcard=work_wechat.TextCard(title="${name}，你的报销已到账", description="金额：${amount} 元", url=url),
+        )
+        for user in users:
+            ww.message_send_template(template, touser=(user["userid"],), variables=user)
+
+    参数同 message_send （不含接收人），变量写作 ${变量名} ，可以出现在任意字符串字段中（比如 taskcard 的 task_id ）；
+    变量值按 JSON 字符串转义后直接拼接到预先序列化的请求体中。
+    """
+
+    _VARIABLE = re.compile(r"\$\{(\w+)\}")
+
+    def __init__(self, msgtype: str, agentid: int, **kwargs):
+        data = _WorkWeChatBase._message_send_data(msgtype=msgtype, agentid=agentid, **kwargs)
+        serialized = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+        # 去掉开头的 "{" ，渲染时先拼接接收人字段；其余部分编译为 % 格式串，渲染时一次格式化
+        parts = self._VARIABLE.split(serialized[1:])
+        self._format = "%s".join(i.replace("%", "%%") for i in parts[0::2]).encode("utf8")
+        self._names = tuple(parts[1::2])
+        self.variables = frozenset(self._names)
+
+    def render(
+            self,
+            variables: typing.Dict[str, typing.Any] = None,
+            touser: typing.Tuple[str, ...] = None,
+            toparty: typing.Tuple[str, ...] = None,
+            totag: typing.Tuple[str, ...] = None,
+    ) -> bytes:
+        """返回替换了变量、加上接收人的 /message/send 请求体，缺少变量时抛出 KeyError"""
+        encode = json.encoder.encode_basestring
+        head = "{"
+        if touser:
+            head += '"touser":%s,' % encode("|".join(touser))
+        if toparty:
+            head += '"toparty":%s,' % encode("|".join(toparty))
+        if totag:
+            head += '"totag":%s,' % encode("|".join(totag))
+        variables = variables or {}
+        values = []
+        for name in self._names:
+            try:
+                v = variables[name]
+            except KeyError:
+                raise KeyError("missing template variable %r" % name)
+            values.append(encode(v if isinstance(v, str) else "%s" % v)[1:-1].encode("utf8"))
+        return head.encode("utf8") + self._format % tuple(values)
+
+
+def _mark(marks: typing.Optional[list]):
+    """记录一个请求阶段的结束时间，没有 metrics 和 hooks 时 marks 为 None"""
+    if marks is not None:
+        marks.append(time.perf_counter())
+
+
+def _pause(marks: list) -> typing.Tuple[float, float]:
+    """流式请求 yield 元素前调用，与 _resume 配合，调用方处理元素的时间不计入请求耗时"""
+    return time.perf_counter(), _thread_time() if isinstance(marks, _ProfiledMarks) else 0.0
 
-    def __init__(self, corpid: str = None, corpsecret: str = None, verbose: bool = False, http_timeout: int = 5):
+
+def _resume(marks: list, paused: typing.Tuple[float, float]):
+    """把已经记录的时间点顺延调用方处理元素的时间"""
+    wall = time.perf_counter() - paused[0]
+    marks[:] = [t + wall for t in marks]
+    if isinstance(marks, _ProfiledMarks):
+        cpu = _thread_time() - paused[1]
+        marks.cpu[:] = [t + cpu for t in marks.cpu]
+
+
+def _api(fn):
+    """
+    接口函数以生成器实现：yield 出 _send_req 的关键字参数，拿到响应后 return 接口结果，请求失败时异常在 yield 处抛出；
+    yield 一个列表（元素为 _send_req 的关键字参数或者另一个接口生成器）时并发执行，按顺序返回结果列表，失败的元素为异常对象；
+    yield 一个 concurrent.futures.Future 时等待它完成（比如等待其他线程正在进行的同一个请求）。
+    WorkWeChat 与 AsyncWorkWeChat 各自用 _run_plan 驱动，共用同一份参数组装与结果处理逻辑。
+    """
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        return self._run_plan(fn(self, *args, **kwargs))
+
+    return wrapper
+
+
+class _WorkWeChatBase(object):
+
+    def __init__(
+            self,
+            corpid: str = None,
+            corpsecret: str = None,
+            verbose: bool = False,
+            http_timeout: int = 5,
+            token_store: TokenStore = None,
+            token_refresh_margin: int = None,
+            rate_limiter: RateLimiter = None,
+            retry_policy: RetryPolicy = None,
+            max_workers: int = 8,
+            directory_cache: DirectoryCache = None,
+            id_cache: IdCache = None,
+            response_cache: ResponseCache = None,
+            media_cache: MediaCache = None,
+            json_codec: JsonCodec = None,
+            metrics: Metrics = None,
+            hooks: typing.Sequence[RequestHooks] = None,
+    ):
         self._corpid = corpid
         self._corpsecret = corpsecret
         self._verbose = verbose
@@ -190,60 +1829,207 @@ class WorkWeChat(object):
         self._access_token_expires_in = 0
         self._access_token = None
 
-    def _update_access_token(self):
-        now = int(time.time())
-        if not self._access_token or now > self._access_token_expires_in:
-            rs = self.gettoken()
+        if token_store is None:
+            token_store = MemoryTokenStore()
+        self._token_store = token_store
+        self._token_key = "%s:%s" % (corpid, hashlib.sha256(("%s" % corpsecret).encode("utf8")).hexdigest()[:16])
+        self._token_refresh_margin = token_refresh_margin
+        self._rate_limiter = rate_limiter
+        self._retry_policy = retry_policy
+        self._max_workers = max_workers
+        self._directory_cache = directory_cache
+        self._id_cache = id_cache
+        self._response_cache = response_cache
+        self._media_cache = media_cache
+        if json_codec is None:
+            json_codec = default_json_codec()
+        self._json = json_codec
+        self._metrics = metrics
+        self._hooks = tuple(hooks or ())
+        self._media_uploads = dict()
+        self._media_uploads_lock = threading.Lock()
+        self._webhook_images = collections.OrderedDict()
+        self._webhook_images_lock = threading.Lock()
+
+    def _access_token_expired(self, margin: int = 0) -> bool:
+        now = time.time()
+        return not self._access_token or now + margin > self._access_token_expires_in
+
+    def _load_access_token(self, margin: int = 0) -> bool:
+        """从 token_store 加载其他进程刷新的 token ，加载到 margin 秒内不过期的 token 返回 True"""
+        token = self._token_store.get(self._token_key)
+        if token is None:
+            return False
+        self._access_token, self._access_token_expires_in = token
+        return not self._access_token_expired(margin)
+
+    def _invalidate_access_token(self, access_token: str):
+        """access_token 被企业微信判定为失效，丢弃本地和 token_store 中的同一个 token"""
+        if self._access_token == access_token:
+            self._access_token = None
+            self._access_token_expires_in = 0
+        token = self._token_store.get(self._token_key)
+        if token is not None and token[0] == access_token:
+            self._token_store.delete(self._token_key)
+
+    @staticmethod
+    def _is_access_token_error(ex: Exception) -> bool:
+        return isinstance(ex, WorkWeChatException) and ex.errcode in (
+            ErrCode.INVALID_ACCESS_TOKEN,
+            ErrCode.ACCESS_TOKEN_EXPIRED,
+        )
+
+    def _transport_error_processed(self, ex: Exception) -> typing.Optional[bool]:
+        """
+        网络异常时请求是否可能已被处理：连接失败返回 False ，读超时等返回 True ，不是网络异常返回 None 。
+        """
+        raise NotImplementedError
+
+    def _retry_delay(self, method: str, path: str, attempt: int, ex: Exception) -> typing.Optional[float]:
+        """请求失败后返回重试前需要等待的秒数，不重试返回 None"""
+        policy = self._retry_policy
+        if policy is None:
+            return None
+        if isinstance(ex, WorkWeChatException):
+            if ex.errcode in policy.throttled_errcodes:
+                processed = False
+            elif ex.errcode in policy.retry_errcodes:
+                processed = True
+            else:
+                return None
+        elif isinstance(ex, HTTPStatusError):
+            if ex.status_code not in policy.retry_status_codes:
+                return None
+            processed = True
+        else:
+            processed = self._transport_error_processed(ex)
+            if processed is None:
+                return None
+        return policy.retry_delay(method, path, attempt, processed)
+
+    @staticmethod
+    def _prepare_files(
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.Any, str]],
+    ) -> typing.Tuple[typing.Dict[str, typing.Tuple[str, typing.Any, str]], typing.Dict[str, int]]:
+        """
+        返回 (params_post_files, {name: 起始位置})：文件对象从当前位置开始上传，记录起始位置，重试前恢复；
+        不能 seek 的流先整个读入内存，重试时重新发送同样的内容
+        """
+        if not params_post_files:
+            return params_post_files, dict()
+        files = dict()
+        starts = dict()
+        for name, (file_name, file_data, file_type) in params_post_files.items():
+            if hasattr(file_data, "read"):
+                seekable = getattr(file_data, "seekable", None)
+                if seekable is not None and seekable():
+                    starts[name] = file_data.tell()
+                else:
+                    file_data = file_data.read()
+            files[name] = (file_name, file_data, file_type)
+        return files, starts
+
+    @staticmethod
+    def _rewind_files(
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.Any, str]],
+            starts: typing.Dict[str, int],
+    ):
+        for name, start in starts.items():
+            params_post_files[name][1].seek(start)
+
+    def _access_token_renew_delay(self) -> float:
+        """距离后台刷新 token 还有多少秒"""
+        return self._access_token_expires_in - self._token_refresh_margin - time.time()
 
-            self._access_token_expires_in = int(time.time()) + rs["expires_in"]
-            self._access_token = rs["access_token"]
+    def _set_access_token(self, rs: dict):
+        self._access_token_expires_in = int(time.time()) + rs["expires_in"]
+        self._access_token = rs["access_token"]
+        self._token_store.set(self._token_key, self._access_token, self._access_token_expires_in)
+        if self._metrics is not None:
+            self._metrics.token_refreshed()
 
-    def get_access_token(self) -> str:
-        self._update_access_token()
-        return self._access_token
+    # 统计 CPU 时间的阶段，AsyncWorkWeChat 中其他阶段会切换协程
+    _CPU_PHASES = Metrics.PHASES
 
-    def _send_req(
+    def _call_hooks(self, name: str, reverse: bool, *args):
+        for hook in reversed(self._hooks) if reverse else self._hooks:
+            try:
+                getattr(hook, name)(*args)
+            except Exception:
+                logging.exception("request hook %r.%s failed" % (hook, name))
+
+    def _request_started(
             self,
             method: str,
             path: str,
-            params_qs: dict = None,
-            params_post: dict = None,
-            params_post_files: typing.Dict[str, typing.Tuple[str, typing.BinaryIO, str]] = None,
-            errcodes_accepted: typing.Tuple[int, ...] = None,
-            auto_update_token: bool = True,
-    ) -> dict:
-        if not errcodes_accepted:
-            errcodes_accepted = (ErrCode.SUCCESS,)
+            params_post: dict,
+            attempt: int,
+    ) -> typing.Optional[RequestInfo]:
+        """
+        开始一次请求（重试算作新的一次），返回的 RequestInfo.marks 交给 _send_req_once 记录各阶段结束时间，
+        没有 metrics 和 hooks 时返回 None
+        """
+        if self._metrics is None and not self._hooks:
+            return None
+        request = RequestInfo(method=method, path=path, params_post=params_post, attempt=attempt)
+        self._call_hooks("before_request", False, request)
+        if self._metrics is not None:
+            self._metrics.request_started(path)
+        request.marks = _ProfiledMarks() if request.profile else []
+        request.marks.append(time.perf_counter())
+        return request
+
+    def _request_finished(self, request: typing.Optional[RequestInfo], rs: dict = None, ex: Exception = None):
+        if request is None:
+            return
+        marks = request.marks
+        if len(marks) <= len(Metrics.PHASES):
+            # 失败或提前结束的阶段记到现在为止
+            marks.append(time.perf_counter())
+        timings = dict(zip(Metrics.PHASES, (b - a for a, b in zip(marks, marks[1:]))))
+        timings["total"] = marks[-1] - marks[0]
+        if request.profile:
+            timings["cpu"] = sum(
+                b - a for phase, a, b in zip(Metrics.PHASES, marks.cpu, marks.cpu[1:]) if phase in self._CPU_PHASES
+            )
+        request.timings = timings
+        if self._metrics is not None:
+            # 返回了 rs 说明 errcode 在接口的 errcodes_accepted 中，不计为失败
+            self._metrics.request_finished(request.path, timings, Metrics.errcode_of(rs, ex), error=ex is not None)
+        if ex is None:
+            self._call_hooks("after_response", True, request, rs)
+        else:
+            self._call_hooks("on_error", True, request, ex)
 
-        if not params_qs:
-            params_qs = dict()
+    def _request_retried(self, request: typing.Optional[RequestInfo], ex: Exception, delay: float):
+        if request is None:
+            return
+        if self._metrics is not None:
+            self._metrics.request_retried(request.path)
+        self._call_hooks("on_retry", False, request, ex, delay)
 
-        if auto_update_token:
-            params_qs["access_token"] = self.get_access_token()
+    # verbose 日志中隐藏的查询参数
+    _SECRET_PARAMS = frozenset(("corpsecret", "access_token", "key"))
 
+    def _build_url(self, method: str, path: str, params_qs: dict) -> str:
         qs = urllib.parse.urlencode(params_qs)
         url = self._url_prefix + path + "?" + qs
-
-        data_post = None
-        if params_post:
-            data_post = json.dumps(params_post)
-
         if self._verbose:
-            logging.debug("%s %s" % (method, url))
-        r = requests.request(
-            method=method,
-            url=url,
-            timeout=self._http_timeout,
-            data=data_post,
-            files=params_post_files
-        )
-        assert r.status_code == 200, r.headers
-        rs = r.json()
+            qs_logged = urllib.parse.urlencode([
+                (k, "***" if k in self._SECRET_PARAMS else v) for k, v in params_qs.items()
+            ])
+            logging.debug("%s %s" % (method, self._url_prefix + path + "?" + qs_logged))
+        return url
+
+    @staticmethod
+    def _check_rs(rs: dict, errcodes_accepted: typing.Tuple[int, ...] = None) -> dict:
+        if not errcodes_accepted:
+            errcodes_accepted = (ErrCode.SUCCESS,)
         if rs["errcode"] not in errcodes_accepted:
             raise WorkWeChatException(errcode=rs["errcode"], errmsg=rs["errmsg"], rs=rs)
-
         return rs
 
+    @_api
     def gettoken(self) -> dict:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/91039
@@ -252,11 +2038,12 @@ class WorkWeChat(object):
             corpid=self._corpid,
             corpsecret=self._corpsecret,
         )
-        qs = urllib.parse.urlencode(params_qs)
-        url = self._url_prefix + "/gettoken?" + qs
-        r = requests.get(url=url, timeout=self._http_timeout)
-        rs = r.json()
-        assert rs["errcode"] == ErrCode.SUCCESS
+        rs = yield dict(
+            auto_update_token=False,
+            method="GET",
+            path="/gettoken",
+            params_qs=params_qs,
+        )
         """
         {
            "errcode": 0,
@@ -270,12 +2057,13 @@ class WorkWeChat(object):
             expires_in=rs["expires_in"],
         )
 
+    @_api
     def get_api_domain_ip(self) -> typing.List[str]:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/92520
         """
 
-        rs = self._send_req(
+        rs = yield dict(
             method="GET",
             path="/get_api_domain_ip",
         )
@@ -291,6 +2079,7 @@ class WorkWeChat(object):
         """
         return rs["ip_list"]
 
+    @_api
     def appchat_get(self, chatid: str) -> typing.Optional[dict]:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90247
@@ -298,7 +2087,7 @@ class WorkWeChat(object):
 
         params_qs = dict(chatid=chatid)
         errcodes_accepted = (ErrCode.SUCCESS, ErrCode.CHATID_INVALID)
-        rs = self._send_req(
+        rs = yield dict(
             method="GET",
             path="/appchat/get",
             params_qs=params_qs,
@@ -318,6 +2107,7 @@ class WorkWeChat(object):
         """
         return rs["chat_info"]
 
+    @_api
     def appchat_send(self, chatid: str, content: str):
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90248
@@ -331,7 +2121,7 @@ class WorkWeChat(object):
             safe=0,
         )
 
-        self._send_req(method="POST", path="/appchat/send", params_post=data)
+        yield dict(method="POST", path="/appchat/send", params_post=data)
         """
          {
            "errcode" : 0,
@@ -339,6 +2129,7 @@ class WorkWeChat(object):
          }
         """
 
+    @_api
     def appchat_create(
             self,
             userlist: typing.Tuple[str, ...],
@@ -360,7 +2151,7 @@ class WorkWeChat(object):
             data["name"] = name
 
         errcodes_accepted = (ErrCode.SUCCESS, ErrCode.CHATID_EXISTED)
-        rs = self._send_req(
+        rs = yield dict(
             method="POST",
             path="/appchat/create",
             params_post=data,
@@ -379,6 +2170,7 @@ class WorkWeChat(object):
 
         return rs["chatid"]
 
+    @_api
     def appchat_update(
             self, chatid: str,
             name: str = None,
@@ -401,7 +2193,7 @@ class WorkWeChat(object):
         if del_user_list is not None:
             data["del_user_list"] = list(del_user_list)
 
-        self._send_req(method="POST", path="/appchat/update", params_post=data)
+        yield dict(method="POST", path="/appchat/update", params_post=data)
         """
          {
            "errcode" : 0,
@@ -410,6 +2202,60 @@ class WorkWeChat(object):
 
         """
 
+    @staticmethod
+    def _check_webhook_image_size(size: int):
+        if size > WEBHOOK_IMAGE_MAX_BYTES:
+            raise ValueError("webhook image is %d bytes, exceeds the limit of %d bytes" % (size, WEBHOOK_IMAGE_MAX_BYTES))
+
+    def _webhook_image(self, image: typing.Union[str, os.PathLike, bytes, memoryview]) -> typing.Tuple[str, str]:
+        """
+        返回图片的 (base64, md5) ，超过 2M 时抛出 ValueError 。
+        文件路径通过 mmap 读取；同一个未修改的文件、相等的 bytes 使用缓存的结果（最多 WEBHOOK_IMAGE_CACHE_SIZE 个）。
+        """
+        if isinstance(image, (str, os.PathLike)):
+            with open(image, "rb") as f:
+                st = os.fstat(f.fileno())
+                self._check_webhook_image_size(st.st_size)
+                key = ("path", os.fspath(image), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+                with self._webhook_images_lock:
+                    cached = self._webhook_images.get(key)
+                if cached is not None:
+                    return cached[1]
+                if st.st_size == 0:
+                    encoded = _encode_image(b"")
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        encoded = _encode_image(m)
+            source = None
+        else:
+            with memoryview(image) as view:
+                self._check_webhook_image_size(view.nbytes)
+            if not isinstance(image, bytes):
+                # memoryview 等可变的数据无法判断内容是否变化，不缓存
+                return _encode_image(image)
+            key = ("bytes", len(image), hash(image))
+            with self._webhook_images_lock:
+                cached = self._webhook_images.get(key)
+            if cached is not None and cached[0] == image:
+                return cached[1]
+            encoded = _encode_image(image)
+            source = image
+
+        with self._webhook_images_lock:
+            self._webhook_images[key] = (source, encoded)
+            self._webhook_images.move_to_end(key)
+            while len(self._webhook_images) > WEBHOOK_IMAGE_CACHE_SIZE:
+                self._webhook_images.popitem(last=False)
+        return encoded
+
+    @staticmethod
+    def _parse_webhook_key(key: str) -> str:
+        if key.startswith("https"):
+            # user pass a url such as "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=..."
+            key = key.split("key=")[-1]
+        return key
+
+    @_api
     def webhook_send(
             self,
             key: str,
@@ -420,13 +2266,18 @@ class WorkWeChat(object):
             news_articles: typing.List[NewsArticle] = None,
             mentioned_list: typing.List[str] = None,
             mentioned_mobile_list: typing.List[str] = None,
+            image: typing.Union[str, os.PathLike, bytes, memoryview] = None,
     ):
         """
         https://work.weixin.qq.com/help?doc_id=13376
+
+        image: 图片文件路径、bytes 或 memoryview ，代替 image_base64 和 image_md5 ，由 SDK 计算，超过 2M 时抛出 ValueError 。
         """
-        if key.startswith("https"):
-            # user pass a url such as "https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=..."
-            key = key.split("key=")[-1]
+        key = self._parse_webhook_key(key)
+        if image is not None:
+            image_base64, image_md5 = self._webhook_image(image)
+        elif image_base64:
+            self._check_webhook_image_size(len(image_base64) // 4 * 3 - image_base64.count("=", -2))
 
         data_qs = dict(
             key=key,
@@ -456,9 +2307,9 @@ class WorkWeChat(object):
             )
         if news_articles:
             data_post["msgtype"] = "news"
-            data_post["news"] = dict(articles=[i.to_dict() for i in news_articles])
+            data_post["news"] = dict(articles=[i.to_dict(drop_none=True) for i in news_articles])
 
-        self._send_req(
+        yield dict(
             auto_update_token=False,
             method="POST",
             path="/webhook/send",
@@ -466,6 +2317,7 @@ class WorkWeChat(object):
             params_post=data_post,
         )
 
+    @_api
     def agent_get(
             self,
             agentid: int,
@@ -474,7 +2326,7 @@ class WorkWeChat(object):
         https://work.weixin.qq.com/api/doc/90000/90135/90227
         """
         data_qs = dict(agentid=agentid)
-        rs = self._send_req(method="POST", path="/agent/get", params_qs=data_qs)
+        rs = yield dict(method="POST", path="/agent/get", params_qs=data_qs)
         """
         {
            "errcode": 0,
@@ -502,39 +2354,72 @@ class WorkWeChat(object):
            "home_url": "https://open.work.weixin.qq.com"
         }
         """
-        rs = copy.deepcopy(rs)
-        for i in (
-                "errcode",
-                "errmsg",
-        ):
-            rs.pop(i)
+        rs = self._drop_fields(rs)
         return rs
 
-    def _drop_fields(self, rs: dict, fields=None) -> dict:
+    @staticmethod
+    def _drop_fields(rs: dict, fields=None) -> dict:
+        """原地删除响应中的 fields（默认 errcode 、errmsg ）并返回 rs ；响应是每次请求新解析的，不需要拷贝"""
         fields_default = (
             "errcode",
             "errmsg",
         )
         if not fields:
             fields = fields_default
-        rs = copy.deepcopy(rs)
         for i in fields:
-            try:
-                rs.pop(i)
-            except KeyError:
-                pass
-            return rs
+            rs.pop(i, None)
+        return rs
+
+    @_api
+    def department_list(self, id: int = None) -> typing.List[dict]:
+        """
+        获取部门 id 及其所有子部门，不填 id 获取全量组织架构。
+        https://work.weixin.qq.com/api/doc/90000/90135/90208
+        """
+        params_qs = dict()
+        if id is not None:
+            params_qs["id"] = id
+        rs = yield dict(method="GET", path="/department/list", params_qs=params_qs)
+        """
+        {
+           "errcode": 0,
+           "errmsg": "ok",
+           "department": [
+               {
+                   "id": 2,
+                   "name": "广州研发中心",
+                   "name_en": "RDGZ",
+                   "parentid": 1,
+                   "order": 10
+               },
+               {
+                   "id": 3,
+                   "name": "邮箱产品部",
+                   "name_en": "mail",
+                   "parentid": 2,
+                   "order": 40
+               }
+           ]
+        }
+        """
+        return rs["department"]
 
+    @_api
     def user_get(self, userid: str) -> typing.Optional[dict]:
         """
         注意：在通讯录同步助手中此接口可以读取企业通讯录的所有成员信息，而自建应用可以读取该应用设置的可见范围内的成员信息。
         https://open.work.weixin.qq.com/api/doc/90000/90135/90196
         """
+        if self._directory_cache is not None:
+            user = self._directory_cache.get(userid)
+            if user is not None:
+                return user
+
         data_qs = dict(
             userid=userid,
         )
         errcodes_accepted = (ErrCode.SUCCESS, ErrCode.USERID_NOT_FOUND)
-        rs = self._send_req(
+        rs = yield dict(
             method="GET",
             path="/user/get",
             params_qs=data_qs,
@@ -614,14 +2499,12 @@ class WorkWeChat(object):
             }
         }        
         """
-        rs = copy.deepcopy(rs)
-        for i in (
-                "errcode",
-                "errmsg",
-        ):
-            rs.pop(i)
+        rs = self._drop_fields(rs)
+        if self._directory_cache is not None:
+            self._directory_cache.put(rs)
         return rs
 
+    @_api
     def user_create(
             self,
             userid: str,
@@ -656,7 +2539,7 @@ class WorkWeChat(object):
 
         errcodes_accepted = (ErrCode.SUCCESS, ErrCode.USERID_EXISTED)
 
-        self._send_req(
+        yield dict(
             method="POST",
             path="/user/create",
             params_post=params_post,
@@ -669,6 +2552,7 @@ class WorkWeChat(object):
         }
         """
 
+    @_api
     def user_update(self, userid: str, **kwargs):
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90197
@@ -677,11 +2561,13 @@ class WorkWeChat(object):
             userid=userid,
         )
         params_post.update(**kwargs)
-        self._send_req(
+        yield dict(
             method="POST",
             path="/user/update",
             params_post=params_post,
         )
+        if self._directory_cache is not None:
+            self._directory_cache.patch(userid, kwargs)
         """
         {
            "errcode": 0,
@@ -689,6 +2575,7 @@ class WorkWeChat(object):
         }        
         """
 
+    @_api
     def user_delete(self, userid: str):
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90198
@@ -696,11 +2583,13 @@ class WorkWeChat(object):
         params_qs = dict(
             userid=userid,
         )
-        self._send_req(
+        yield dict(
             method="GET",
             path="/user/delete",
             params_qs=params_qs,
         )
+        if self._directory_cache is not None:
+            self._directory_cache.evict(userid)
         """
         {
            "errcode": 0,
@@ -708,18 +2597,35 @@ class WorkWeChat(object):
         }
         """
 
-    def user_batchdelete(self, useridlist: typing.List[str]):
+    @_api
+    def user_batchdelete(self, useridlist: typing.Iterable[str]):
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90199
+
+        useridlist 个数不限：按接口限制（每次最多 200 个）分批，各批次并发删除（并发数见 max_workers ）；
+        有批次失败时在所有批次结束后抛出 BatchDeleteError ，其 failed 为删除失败的成员及原因：
+
+        {
+            "userid1": WorkWeChatException(...),
+            "userid2": WorkWeChatException(...),
+        }
         """
-        params_post = dict(
-            useridlist=useridlist,
-        )
-        self._send_req(
-            method="POST",
-            path="/user/batchdelete",
-            params_post=params_post,
-        )
+        chunks = list(_chunked(useridlist, USER_BATCHDELETE_MAX))
+        reqs = [
+            dict(method="POST", path="/user/batchdelete", params_post=dict(useridlist=chunk))
+            for chunk in chunks
+        ]
+        rs_list = yield reqs
+
+        failed = {}
+        for chunk, rs in zip(chunks, rs_list):
+            if isinstance(rs, Exception):
+                failed.update((i, rs) for i in chunk)
+            elif self._directory_cache is not None:
+                for i in chunk:
+                    self._directory_cache.evict(i)
+        if failed:
+            raise BatchDeleteError(failed) from next(iter(failed.values()))
         """
         {
            "errcode": 0,
@@ -727,6 +2633,7 @@ class WorkWeChat(object):
         }
         """
 
+    @_api
     def user_simplelist(
             self,
             department_id: str,
@@ -739,7 +2646,7 @@ class WorkWeChat(object):
             department_id=department_id,
             fetch_child=int(fetch_child),
         )
-        rs = self._send_req(method="GET", path="/user/simplelist", params_qs=data)
+        rs = yield dict(method="GET", path="/user/simplelist", params_qs=data)
         """
         {
            "errcode": 0,
@@ -756,6 +2663,7 @@ class WorkWeChat(object):
         """
         return rs["userlist"]
 
+    @_api
     def user_list(
             self,
             department_id: int,
@@ -768,7 +2676,7 @@ class WorkWeChat(object):
             department_id=department_id,
             fetch_child=int(fetch_child),
         )
-        rs = self._send_req(method="GET", path="/user/list", params_qs=data)
+        rs = yield dict(method="GET", path="/user/list", params_qs=data)
         """
         {
             "errcode": 0,
@@ -845,16 +2753,123 @@ class WorkWeChat(object):
             }]
         }
         """
+        if self._directory_cache is not None:
+            self._directory_cache.put_snapshot(rs["userlist"])
         return rs["userlist"]
 
+    @staticmethod
+    def _bulk_results(
+            results: typing.Iterable[typing.Tuple[typing.Tuple[int, typing.Any], typing.Any]],
+    ) -> typing.List[BulkResult]:
+        """把 _imap_unordered 返回的 ((序号, 元素), 结果或异常) 按序号排列为 BulkResult 列表"""
+        bulk_results = []
+        for (index, item), rs in results:
+            if isinstance(rs, Exception):
+                bulk_results.append((index, BulkResult(item, exception=rs)))
+            else:
+                bulk_results.append((index, BulkResult(item, result=rs)))
+        bulk_results.sort(key=lambda i: i[0])
+        return [i for _, i in bulk_results]
+
+    @staticmethod
+    def _user_list_stream_req(path: str, department_id: int, fetch_child: bool) -> dict:
+        """iter_user_list 、iter_user_simplelist 的请求参数"""
+        return dict(
+            method="GET",
+            path=path,
+            field="userlist",
+            params_qs=dict(
+                department_id=department_id,
+                fetch_child=int(fetch_child),
+            ),
+        )
+
+    @_api
+    def user_list_id(self, cursor: str = None, limit: int = 10000) -> dict:
+        """
+        https://developer.work.weixin.qq.com/document/path/96067
+        """
+        params_post = dict(limit=limit)
+        if cursor:
+            params_post["cursor"] = cursor
+        rs = yield dict(method="POST", path="/user/list_id", params_post=params_post)
+        """
+        {
+            "errcode": 0,
+            "errmsg": "ok",
+            "next_cursor": "xxxxxx",
+            "dept_user": [
+                {
+                    "userid": "userid1",
+                    "department": 1
+                },
+                {
+                    "open_userid": "gggg",
+                    "department": 2
+                }
+            ]
+        }
+        """
+        return dict(
+            next_cursor=rs.get("next_cursor"),
+            dept_user=rs["dept_user"],
+        )
+
+    def _translate_id(self, kind: str, field: str, key: str, req: dict) -> str:
+        if self._id_cache is not None:
+            value = self._id_cache.get_many(self._corpid, kind, (key,)).get(key)
+            if value is not None:
+                return value
+        rs = yield req
+        if self._id_cache is not None:
+            self._id_cache.set_many(self._corpid, kind, {key: rs[field]})
+        return rs[field]
+
+    def _translate_ids(
+            self,
+            kind: str,
+            field: str,
+            keys: typing.Iterable[str],
+            make_req: typing.Callable[[str], dict],
+    ) -> typing.Dict[str, typing.Union[str, Exception]]:
+        """
+        批量 ID 转换：先查 id_cache ，未命中的并发请求接口（并发数见 max_workers ），成功的结果写回 id_cache 。
+        返回 {key: 转换结果} ，失败的 key 对应异常对象。
+        """
+        keys = list(dict.fromkeys(keys))
+        values = dict()
+        if self._id_cache is not None:
+            values.update(self._id_cache.get_many(self._corpid, kind, keys))
+        misses = [k for k in keys if k not in values]
+        if not misses:
+            return values
+
+        rs_list = yield [make_req(k) for k in misses]
+
+        fetched = dict()
+        for k, rs in zip(misses, rs_list):
+            if isinstance(rs, Exception):
+                values[k] = rs
+            else:
+                values[k] = fetched[k] = rs[field]
+        if self._id_cache is not None:
+            self._id_cache.set_many(self._corpid, kind, fetched)
+        return values
+
+    @staticmethod
+    def _convert_to_openid_req(userid: str) -> dict:
+        return dict(method="POST", path="/user/convert_to_openid", params_post=dict(userid=userid))
+
+    @staticmethod
+    def _convert_to_userid_req(openid: str) -> dict:
+        return dict(method="POST", path="/user/convert_to_userid", params_post=dict(openid=openid))
+
+    @_api
     def user_convert_to_openid(self, userid: str) -> str:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90202
         """
-        params_qs = dict(
-            userid=userid,
-        )
-        rs = self._send_req(method="POST", path="/user/convert_to_openid", params_qs=params_qs)
+        return (yield from self._translate_id("openid", "openid", userid, self._convert_to_openid_req(userid)))
         """
         {
            "errcode": 0,
@@ -862,16 +2877,13 @@ class WorkWeChat(object):
            "openid": "oDjGHs-1yCnGrRovBj2yHij5JAAA"
         }
         """
-        return rs["openid"]
 
+    @_api
     def user_convert_to_userid(self, openid: str) -> str:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90202
         """
-        params_qs = dict(
-            openid=openid,
-        )
-        rs = self._send_req(method="POST", path="/user/convert_to_openid", params_qs=params_qs)
+        return (yield from self._translate_id("userid", "userid", openid, self._convert_to_userid_req(openid)))
         """
         {
            "errcode": 0,
@@ -879,16 +2891,31 @@ class WorkWeChat(object):
            "userid": "zhangsan"
         }
         """
-        return rs["userid"]
 
-    def user_authsucc(self, userid: str):
+    @_api
+    def user_batch_convert_to_openid(self, userids: typing.Iterable[str]) -> typing.Dict[str, typing.Union[str, Exception]]:
         """
-        https://work.weixin.qq.com/api/doc/90000/90135/90203
+        批量 user_convert_to_openid ：已缓存的直接返回（见 id_cache ），其余并发请求。
+        返回 {userid: openid} ，转换失败的 userid 对应异常对象。
         """
-        params_qs = dict(
-            userid=userid,
-        )
-        self._send_req(method="POST", path="/user/authsucc", params_qs=params_qs)
+        return (yield from self._translate_ids("openid", "openid", userids, self._convert_to_openid_req))
+
+    @_api
+    def user_batch_convert_to_userid(self, openids: typing.Iterable[str]) -> typing.Dict[str, typing.Union[str, Exception]]:
+        """
+        批量 user_convert_to_userid ，返回 {openid: userid} ，其他同 user_batch_convert_to_openid 。
+        """
+        return (yield from self._translate_ids("userid", "userid", openids, self._convert_to_userid_req))
+
+    @_api
+    def user_authsucc(self, userid: str):
+        """
+        https://work.weixin.qq.com/api/doc/90000/90135/90203
+        """
+        params_qs = dict(
+            userid=userid,
+        )
+        yield dict(method="POST", path="/user/authsucc", params_qs=params_qs)
         """
         {
            "errcode": 0,
@@ -896,6 +2923,7 @@ class WorkWeChat(object):
         }
         """
 
+    @_api
     def batch_invite(
             self,
             user: typing.List[str] = None,
@@ -919,7 +2947,7 @@ class WorkWeChat(object):
             assert len(tag) < maxItem
             params_post["tag"] = tag
 
-        rs = self._send_req(method="POST", path="/batch/invite", params_post=params_post)
+        rs = yield dict(method="POST", path="/batch/invite", params_post=params_post)
         """
          {
            "errcode" : 0,
@@ -929,14 +2957,10 @@ class WorkWeChat(object):
            "invalidtag": [TagID1, TagID2]
          }
         """
-        rs = copy.deepcopy(rs)
-        for i in (
-                "errcode",
-                "errmsg",
-        ):
-            rs.pop(i)
+        rs = self._drop_fields(rs)
         return rs
 
+    @_api
     def corp_get_join_qrcode(self, size_type: int = None) -> str:
         """
         注意：须拥有通讯录的管理权限，使用通讯录同步的Secret。
@@ -946,7 +2970,7 @@ class WorkWeChat(object):
         params_qs = dict()
         if size_type:
             params_qs["size_type"] = size_type
-        rs = self._send_req(method="GET", path="/corp/get_join_qrcode", params_qs=params_qs)
+        rs = yield dict(method="GET", path="/corp/get_join_qrcode", params_qs=params_qs)
         """
         {
            "errcode": 0,
@@ -956,17 +2980,28 @@ class WorkWeChat(object):
         """
         return rs["join_qrcode"]
 
-    def user_get_mobile_hashcode(self, mobile: str, state: str = None) -> str:
-        """
-        注意：仅限自建应用调用。
-        https://work.weixin.qq.com/api/doc/90000/90135/91735
-        """
+    @staticmethod
+    def _mobile_hashcode_kind(state: str = None) -> str:
+        # hashcode 与 state 相关，不同 state 分开缓存
+        return "mobile_hashcode:%s" % (state or "")
+
+    @staticmethod
+    def _get_mobile_hashcode_req(mobile: str, state: str = None) -> dict:
         params_post = dict(
             mobile=mobile,
         )
         if state:
             params_post["state"] = state
-        rs = self._send_req(method="POST", path="/user/get_mobile_hashcode", params_post=params_post)
+        return dict(method="POST", path="/user/get_mobile_hashcode", params_post=params_post)
+
+    @_api
+    def user_get_mobile_hashcode(self, mobile: str, state: str = None) -> str:
+        """
+        注意：仅限自建应用调用。
+        https://work.weixin.qq.com/api/doc/90000/90135/91735
+        """
+        req = self._get_mobile_hashcode_req(mobile, state)
+        return (yield from self._translate_id(self._mobile_hashcode_kind(state), "hashcode", mobile, req))
         """
         {
            "errcode": 0,
@@ -974,8 +3009,24 @@ class WorkWeChat(object):
            "hashcode": "1abcd2xaba3dxab4sdxa"
         }
         """
-        return rs["hashcode"]
 
+    @_api
+    def user_batch_get_mobile_hashcode(
+            self,
+            mobiles: typing.Iterable[str],
+            state: str = None,
+    ) -> typing.Dict[str, typing.Union[str, Exception]]:
+        """
+        批量 user_get_mobile_hashcode ，返回 {mobile: hashcode} ，其他同 user_batch_convert_to_openid 。
+        """
+        return (yield from self._translate_ids(
+            self._mobile_hashcode_kind(state),
+            "hashcode",
+            mobiles,
+            lambda mobile: self._get_mobile_hashcode_req(mobile, state),
+        ))
+
+    @_api
     def user_get_active_stat(self, date: str) -> int:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/92714
@@ -983,7 +3034,7 @@ class WorkWeChat(object):
         params_post = dict(
             date=date,
         )
-        rs = self._send_req(method="POST", path="/user/get_active_stat", params_post=params_post)
+        rs = yield dict(method="POST", path="/user/get_active_stat", params_post=params_post)
         """
         {
            "errcode": 0,
@@ -993,9 +3044,13 @@ class WorkWeChat(object):
         """
         return rs["active_cnt"]
 
+    @_api
     def media_upload(self, media: Media) -> str:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/90253
+
+        设置了 media_cache 时，相同内容、相同类型的文件在有效期内直接返回缓存的 media_id ；
+        多个线程（或协程）同时上传同一个文件时只上传一次。
         """
         params_qs = dict(type=MIMETYPE2WWTYPE.get(media.file_type, DEFAULT_CONTENT_TYPE))
 
@@ -1010,24 +3065,80 @@ class WorkWeChat(object):
         ---------------------------acebdf13572468--
 
         """
+        file_data = media.file_data
+        if file_data is None:
+            file_data = pathlib.Path(media.file_path)
+
+        cache_key = None
+        if self._media_cache is not None:
+            if hasattr(file_data, "seekable") and not file_data.seekable():
+                # 计算 sha256 后还要上传，无法回退的流先读入内存
+                file_data = file_data.read()
+            cache_key = (self._corpid, params_qs["type"], _media_digest(file_data))
+            media_id = self._media_cache.get(*cache_key)
+            if media_id is not None:
+                return media_id
+            while True:
+                with self._media_uploads_lock:
+                    uploading = self._media_uploads.get(cache_key)
+                    if uploading is None:
+                        self._media_uploads[cache_key] = concurrent.futures.Future()
+                if uploading is None:
+                    break
+                media_id = yield uploading
+                if media_id is not None:
+                    return media_id
+                # 上传的线程（或协程）被取消，由当前调用上传
+
         files = {
-            "media": (media.file_name, media.file_data, media.file_type)
-        }
-        rs = self._send_req(method="POST", path="/media/upload", params_post_files=files, params_qs=params_qs)
-        """
-        {
-           "errcode": 0,
-           "errmsg": ""，
-           "type": "image",
-           "media_id": "1G6nrLmr5EC3MMb_-zK1dDdzmd0p7cNliYu9V5w7o8K0",
-           "created_at": "1380000000"
+            "media": (media.file_name, file_data, media.file_type)
         }
-        """
+        try:
+            rs = yield dict(method="POST", path="/media/upload", params_post_files=files, params_qs=params_qs)
+            """
+            {
+               "errcode": 0,
+               "errmsg": ""，
+               "type": "image",
+               "media_id": "1G6nrLmr5EC3MMb_-zK1dDdzmd0p7cNliYu9V5w7o8K0",
+               "created_at": "1380000000"
+            }
+            """
+            if cache_key is not None:
+                expires_at = int(rs.get("created_at") or time.time()) + MEDIA_EXPIRES_IN
+                self._media_cache.set(*cache_key, rs["media_id"], expires_at)
+        except Exception as ex:
+            if cache_key is not None:
+                self._media_upload_finished(cache_key, exception=ex)
+            raise
+        except BaseException:
+            if cache_key is not None:
+                self._media_upload_finished(cache_key)
+            raise
+        if cache_key is not None:
+            self._media_upload_finished(cache_key, media_id=rs["media_id"])
 
         return rs['media_id']
 
-    def message_send(
-            self,
+    def _media_upload_finished(self, cache_key: tuple, media_id: str = None, exception: Exception = None):
+        """通知等待同一个文件上传的调用，media_id 和 exception 都为 None 表示上传被取消，等待的调用各自重新上传"""
+        with self._media_uploads_lock:
+            uploading = self._media_uploads.pop(cache_key)
+        if uploading.done():
+            return
+        if exception is not None:
+            uploading.set_exception(exception)
+        else:
+            uploading.set_result(media_id)
+
+    @staticmethod
+    def _as_media(media: typing.Union[Media, str, os.PathLike]) -> Media:
+        if isinstance(media, Media):
+            return media
+        return Media.from_path(os.fspath(media))
+
+    @staticmethod
+    def _message_send_data(
             msgtype: str,
             agentid: int,
             content: str = None,
@@ -1037,18 +3148,12 @@ class WorkWeChat(object):
             news_articles: typing.Tuple[NewsArticle, ...] = None,
             mpnews_articles: typing.Tuple[MpNew, ...] = None,
             taskcard: TaskCard = None,
-            touser: typing.Tuple[str, ...] = None,
-            toparty: typing.Tuple[str, ...] = None,
-            totag: typing.Tuple[str, ...] = None,
             safe: int = 0,
             enable_id_trans: int = 0,
             enable_duplicate_check: int = 0,
             duplicate_check_interval: int = 1800
     ) -> dict:
-
-        """
-        https://work.weixin.qq.com/api/doc/90000/90135/90236
-        """
+        """message_send 除接收人以外的请求参数"""
         data = dict(
             msgtype=msgtype,
             agentid=agentid,
@@ -1071,16 +3176,65 @@ class WorkWeChat(object):
         elif msgtype == MsgType.FILE or msgtype == MsgType.IMAGE or msgtype == MsgType.VOICE:
             data[msgtype] = dict(media_id=media_id)
         elif msgtype == MsgType.NEWS or msgtype == MsgType.MPNEWS:
-            data[msgtype] = dict(articles=[i.to_dict() for i in object_type_dict[msgtype]])
+            data[msgtype] = dict(articles=[i.to_dict(drop_none=True) for i in object_type_dict[msgtype]])
         else:
-            data[msgtype] = object_type_dict[msgtype].to_dict()
+            data[msgtype] = object_type_dict[msgtype].to_dict(drop_none=True)
+        return data
 
+    @staticmethod
+    def _set_message_recipients(
+            data: dict,
+            touser: typing.Tuple[str, ...] = None,
+            toparty: typing.Tuple[str, ...] = None,
+            totag: typing.Tuple[str, ...] = None,
+    ):
         if touser:
             data["touser"] = '|'.join(touser)
         if toparty:
             data["toparty"] = '|'.join(toparty)
         if totag:
             data["totag"] = '|'.join(totag)
+
+    @_api
+    def message_send(
+            self,
+            msgtype: str,
+            agentid: int,
+            content: str = None,
+            media_id: str = None,
+            video: Video = None,
+            textcard: TextCard = None,
+            news_articles: typing.Tuple[NewsArticle, ...] = None,
+            mpnews_articles: typing.Tuple[MpNew, ...] = None,
+            taskcard: TaskCard = None,
+            touser: typing.Tuple[str, ...] = None,
+            toparty: typing.Tuple[str, ...] = None,
+            totag: typing.Tuple[str, ...] = None,
+            safe: int = 0,
+            enable_id_trans: int = 0,
+            enable_duplicate_check: int = 0,
+            duplicate_check_interval: int = 1800
+    ) -> dict:
+
+        """
+        https://work.weixin.qq.com/api/doc/90000/90135/90236
+        """
+        data = self._message_send_data(
+            msgtype=msgtype,
+            agentid=agentid,
+            content=content,
+            media_id=media_id,
+            video=video,
+            textcard=textcard,
+            news_articles=news_articles,
+            mpnews_articles=mpnews_articles,
+            taskcard=taskcard,
+            safe=safe,
+            enable_id_trans=enable_id_trans,
+            enable_duplicate_check=enable_duplicate_check,
+            duplicate_check_interval=duplicate_check_interval,
+        )
+        self._set_message_recipients(data, touser=touser, toparty=toparty, totag=totag)
         """
         {
            "touser" : "UserID1|UserID2|UserID3",
@@ -1098,7 +3252,7 @@ class WorkWeChat(object):
         }
         """
 
-        rs = self._send_req(
+        rs = yield dict(
             method="POST",
             path="/message/send",
             params_post=data,
@@ -1112,14 +3266,108 @@ class WorkWeChat(object):
            "invalidtag": "tagid1|tagid2"
          }
         """
-        rs = copy.deepcopy(rs)
-        for i in (
-                "errcode",
-                "errmsg",
-        ):
-            rs.pop(i)
+        rs = self._drop_fields(rs)
+        return rs
+
+    @_api
+    def message_send_template(
+            self,
+            template: MessageTemplate,
+            variables: typing.Dict[str, typing.Any] = None,
+            touser: typing.Tuple[str, ...] = None,
+            toparty: typing.Tuple[str, ...] = None,
+            totag: typing.Tuple[str, ...] = None,
+    ) -> dict:
+        """
+        按 MessageTemplate 发送应用消息，variables 为模板中的变量值，返回值同 message_send 。
+        """
+        rs = yield dict(
+            method="POST",
+            path="/message/send",
+            body=template.render(variables, touser=touser, toparty=toparty, totag=totag),
+        )
+        return self._drop_fields(rs)
+
+    @_api
+    def message_broadcast(
+            self,
+            msgtype: str,
+            agentid: int,
+            content: str = None,
+            media_id: str = None,
+            video: Video = None,
+            textcard: TextCard = None,
+            news_articles: typing.Tuple[NewsArticle, ...] = None,
+            mpnews_articles: typing.Tuple[MpNew, ...] = None,
+            taskcard: TaskCard = None,
+            touser: typing.Iterable[str] = None,
+            toparty: typing.Iterable[str] = None,
+            totag: typing.Iterable[str] = None,
+            safe: int = 0,
+            enable_id_trans: int = 0,
+            enable_duplicate_check: int = 0,
+            duplicate_check_interval: int = 1800
+    ) -> dict:
+        """
+        参数同 message_send ，接收人个数不限：按接口限制（touser 最多 1000 个，toparty 、totag 最多 100 个）分批，
+        各批次并发发送（并发数见 max_workers ），合并各批次结果：
+
+        {
+            "invaliduser": "userid1|userid2",
+            "invalidparty": "partyid1|partyid2",
+            "invalidtag": "tagid1|tagid2",
+            "failed": [
+                {"touser": (...), "toparty": (...), "totag": (...), "exception": WorkWeChatException(...)},
+            ]
+        }
+
+        注意：企业微信只在同一次请求内对接收人去重，同一个成员同时在不同批次的 touser 和 toparty 中会收到多条消息。
+        """
+        data = self._message_send_data(
+            msgtype=msgtype,
+            agentid=agentid,
+            content=content,
+            media_id=media_id,
+            video=video,
+            textcard=textcard,
+            news_articles=news_articles,
+            mpnews_articles=mpnews_articles,
+            taskcard=taskcard,
+            safe=safe,
+            enable_id_trans=enable_id_trans,
+            enable_duplicate_check=enable_duplicate_check,
+            duplicate_check_interval=duplicate_check_interval,
+        )
+
+        chunks = list(itertools.zip_longest(
+            _chunked(touser or (), MESSAGE_MAX_TOUSER),
+            _chunked(toparty or (), MESSAGE_MAX_TOPARTY),
+            _chunked(totag or (), MESSAGE_MAX_TOTAG),
+            fillvalue=(),
+        ))
+        reqs = []
+        for chunk_touser, chunk_toparty, chunk_totag in chunks:
+            chunk_data = dict(data)
+            self._set_message_recipients(chunk_data, touser=chunk_touser, toparty=chunk_toparty, totag=chunk_totag)
+            reqs.append(dict(method="POST", path="/message/send", params_post=chunk_data))
+
+        rs_list = yield reqs
+
+        invalid = dict(invaliduser=[], invalidparty=[], invalidtag=[])
+        failed = []
+        for (chunk_touser, chunk_toparty, chunk_totag), rs in zip(chunks, rs_list):
+            if isinstance(rs, Exception):
+                failed.append(dict(touser=chunk_touser, toparty=chunk_toparty, totag=chunk_totag, exception=rs))
+                continue
+            for k, v in invalid.items():
+                if rs.get(k):
+                    v.append(rs[k])
+
+        rs = dict((k, "|".join(v)) for k, v in invalid.items())
+        rs["failed"] = failed
         return rs
 
+    @_api
     def update_taskcard(
             self,
             userids: typing.Tuple[str, ...],
@@ -1139,7 +3387,7 @@ class WorkWeChat(object):
             "clicked_key": "btn_key123"
         }   
         """
-        rs = self._send_req(
+        rs = yield dict(
             method="POST",
             path="/message/update_taskcard",
             params_post=params_post
@@ -1153,6 +3401,7 @@ class WorkWeChat(object):
         """
         return rs["invaliduser"]
 
+    @_api
     def message_get_statistics(self, time_type: int = 0) -> typing.List[dict]:
         """
         https://work.weixin.qq.com/api/doc/90000/90135/92369
@@ -1164,7 +3413,7 @@ class WorkWeChat(object):
            "time_type": 0
         }
         """
-        rs = self._send_req(
+        rs = yield dict(
             method="POST",
             path="/message/get_statistics",
             params_post=params_post
@@ -1188,3 +3437,1514 @@ class WorkWeChat(object):
         }
         """
         return rs["statistics"]
+
+
+class WorkWeChat(_WorkWeChatBase):
+
+    def __init__(
+            self,
+            corpid: str = None,
+            corpsecret: str = None,
+            verbose: bool = False,
+            http_timeout: int = 5,
+            pool_connections: int = 10,
+            pool_maxsize: int = 10,
+            pool_block: bool = False,
+            keep_alive: bool = True,
+            session: requests.Session = None,
+            token_store: TokenStore = None,
+            token_refresh_margin: int = None,
+            rate_limiter: RateLimiter = None,
+            retry_policy: RetryPolicy = None,
+            max_workers: int = 8,
+            directory_cache: DirectoryCache = None,
+            id_cache: IdCache = None,
+            response_cache: ResponseCache = None,
+            media_cache: MediaCache = None,
+            json_codec: JsonCodec = None,
+            metrics: Metrics = None,
+            hooks: typing.Sequence[RequestHooks] = None,
+    ):
+        """
+        pool_connections: 连接池缓存的 host 数；
+        pool_maxsize: 每个 host 最多保持的连接数，多线程共享同一个 WorkWeChat 时建议不小于线程数；
+        pool_block: 连接池用尽时是否阻塞等待空闲连接，否则临时新建连接（用完即丢弃）；
+        keep_alive: 是否复用 TCP/TLS 连接；
+        session: 自定义 requests.Session ，传入后连接池参数无效，且 close() 不会关闭它；
+        token_store: access_token 存储，默认为进程内存储，多进程共用 token 见 FileTokenStore ；
+        token_refresh_margin: 开启后台刷新 token ，在过期前多少秒（须小于 expires_in）由后台线程刷新，请求不再等待 /gettoken ；默认不开启；
+        rate_limiter: 按接口限流，超出频率的请求阻塞排队，见 RateLimiter ；
+        retry_policy: 失败自动重试，见 RetryPolicy ，默认不重试；
+        max_workers: message_broadcast 等批量接口的并发线程数，建议不大于 pool_maxsize ；
+        directory_cache: 通讯录缓存，见 DirectoryCache ，默认不缓存；
+        id_cache: userid/openid 、手机号 hashcode 转换结果缓存，见 SqliteIdCache ，默认不缓存；
+        response_cache: agent_get 等读接口的响应缓存，见 ResponseCache ，默认不缓存；
+        media_cache: media_upload 结果缓存，相同的文件不重复上传，见 MediaCache ，默认不缓存；
+        json_codec: 请求、响应的 JSON 编解码，见 JsonCodec ，默认安装了 orjson 时使用 orjson ；
+        metrics: 记录各接口耗时、errcode 分布等指标，见 Metrics ，默认不记录；
+        hooks: 请求前后、失败、重试时调用的钩子，见 RequestHooks 、RequestProfiler 。
+        """
+        super().__init__(
+            corpid=corpid,
+            corpsecret=corpsecret,
+            verbose=verbose,
+            http_timeout=http_timeout,
+            token_store=token_store,
+            token_refresh_margin=token_refresh_margin,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            max_workers=max_workers,
+            directory_cache=directory_cache,
+            id_cache=id_cache,
+            response_cache=response_cache,
+            media_cache=media_cache,
+            json_codec=json_codec,
+            metrics=metrics,
+            hooks=hooks,
+        )
+
+        self._session_owned = session is None
+        if session is None:
+            session = self._create_session(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                keep_alive=keep_alive,
+            )
+        self._session = session
+
+        self._access_token_lock = threading.Lock()
+        self._access_token_renewer = None
+        self._closed = threading.Event()
+
+    @staticmethod
+    def _create_session(
+            pool_connections: int,
+            pool_maxsize: int,
+            pool_block: bool,
+            keep_alive: bool,
+    ) -> requests.Session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def close(self):
+        self._closed.set()
+        if self._session_owned:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run_plan(self, plan: typing.Generator):
+        try:
+            req = next(plan)
+            while True:
+                try:
+                    if isinstance(req, list):
+                        rs = self._run_concurrently(req)
+                    elif isinstance(req, concurrent.futures.Future):
+                        rs = req.result()
+                    else:
+                        rs = self._send_req(**req)
+                except BaseException as ex:
+                    # KeyboardInterrupt 等也交给 plan 处理，plan 可以在抛出前清理状态
+                    req = plan.throw(ex)
+                    continue
+                req = plan.send(rs)
+        except StopIteration as ex:
+            return ex.value
+
+    def _run_plan_item(self, item: typing.Union[dict, typing.Generator]):
+        if isinstance(item, dict):
+            return self._send_req(**item)
+        return self._run_plan(item)
+
+    def _run_concurrently(self, items: typing.List[typing.Union[dict, typing.Generator]]) -> list:
+        # 每次并发单独创建线程池，嵌套的并发请求不会因为共用线程池而互相等待
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self._max_workers, len(items)))) as executor:
+            futures = [executor.submit(self._run_plan_item, i) for i in items]
+        return [i.exception() or i.result() for i in futures]
+
+    def _transport_error_processed(self, ex: Exception) -> typing.Optional[bool]:
+        if isinstance(ex, requests.exceptions.ConnectTimeout):
+            return False
+        if isinstance(ex, requests.exceptions.ConnectionError):
+            # 连接被拒绝等建立连接阶段的错误包装为 MaxRetryError(reason=NewConnectionError)
+            reason = getattr(ex.args[0], "reason", None) if ex.args else None
+            return not isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+        if isinstance(ex, requests.exceptions.Timeout):
+            return True
+        return None
+
+    def _send_req_stream(
+            self,
+            method: str,
+            path: str,
+            field: str,
+            params_qs: dict = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+    ) -> typing.Iterator[dict]:
+        """
+        同 _send_req ，响应形如 {"errcode": 0, field: [...]} ，边下载边解析，逐个返回 field 数组中的元素。
+        已经返回过元素后失败不再重试。
+        """
+        if not params_qs:
+            params_qs = dict()
+        if self._retry_policy is not None:
+            self._retry_policy.deposit()
+
+        attempt = 0
+        tries = 0
+        access_token_invalidated = False
+        yielded = False
+        while True:
+            request = self._request_started(method, path, None, tries)
+            tries += 1
+            parser = _JsonArrayStream(field)
+            try:
+                for i in self._send_req_stream_once(
+                        method=method,
+                        path=path,
+                        parser=parser,
+                        params_qs=params_qs,
+                        errcodes_accepted=errcodes_accepted,
+                        marks=None if request is None else request.marks,
+                ):
+                    yielded = True
+                    yield i
+            except Exception as ex:
+                self._request_finished(request, ex=ex)
+                if yielded:
+                    raise
+                if not access_token_invalidated and self._is_access_token_error(ex):
+                    access_token_invalidated = True
+                    self._invalidate_access_token(params_qs["access_token"])
+                    self._request_retried(request, ex, 0)
+                    continue
+
+                delay = self._retry_delay(method, path, attempt, ex)
+                if delay is None:
+                    raise
+                logging.warning("%s %s failed (%r), retry in %.2fs" % (method, path, ex, delay))
+                self._request_retried(request, ex, delay)
+                time.sleep(delay)
+                attempt += 1
+            except GeneratorExit:
+                # 调用方提前结束遍历，不是请求失败
+                self._request_finished(request, rs=parser.envelope)
+                raise
+            except BaseException as ex:
+                # 取消（CancelledError）、KeyboardInterrupt 等
+                self._request_finished(request, ex=ex)
+                raise
+            else:
+                self._request_finished(request, rs=parser.envelope)
+                return
+
+    def _send_req_stream_once(
+            self,
+            method: str,
+            path: str,
+            parser: _JsonArrayStream,
+            params_qs: dict,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            marks: list = None,
+    ) -> typing.Iterator[dict]:
+        """http 阶段到收到响应头为止，decode 阶段为下载、解析响应体，不含调用方处理元素的时间"""
+        params_qs["access_token"] = self.get_access_token()
+        _mark(marks)
+
+        if self._rate_limiter is not None:
+            delay = self._rate_limiter.reserve(path)
+            if delay > 0:
+                time.sleep(delay)
+        _mark(marks)
+
+        url = self._build_url(method, path, params_qs)
+        _mark(marks)
+
+        with self._session.request(method=method, url=url, timeout=self._http_timeout, stream=True) as r:
+            if r.status_code != 200:
+                raise HTTPStatusError(status_code=r.status_code, headers=r.headers)
+            _mark(marks)
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                for i in parser.feed(chunk):
+                    if marks is None:
+                        yield i
+                        continue
+                    paused = _pause(marks)
+                    yield i
+                    _resume(marks, paused)
+            parser.finish()
+        _mark(marks)
+        self._check_rs(parser.envelope, errcodes_accepted)
+
+    def iter_user_list(self, department_id: int, fetch_child: bool = False) -> typing.Iterator[dict]:
+        """
+        同 user_list ，边下载边解析，逐个返回成员，内存占用不随成员数增长。
+        """
+        req = self._user_list_stream_req("/user/list", department_id, fetch_child)
+        for user in self._send_req_stream(**req):
+            if self._directory_cache is not None:
+                self._directory_cache.put_snapshot((user,))
+            yield user
+
+    def iter_user_simplelist(self, department_id: int, fetch_child: bool = False) -> typing.Iterator[dict]:
+        """
+        同 user_simplelist ，边下载边解析，逐个返回成员。
+        """
+        req = self._user_list_stream_req("/user/simplelist", department_id, fetch_child)
+        return self._send_req_stream(**req)
+
+    def iter_user_list_id(self, limit: int = 10000) -> typing.Iterator[dict]:
+        """
+        按游标分页获取全部成员的 userid 和所属部门（ user_list_id ），逐个返回 {"userid": ..., "department": ...} 。
+        """
+        cursor = None
+        while True:
+            rs = self.user_list_id(cursor=cursor, limit=limit)
+            for i in rs["dept_user"]:
+                yield i
+            cursor = rs["next_cursor"]
+            if not cursor:
+                return
+
+    def iter_department_users(
+            self,
+            department_id: int = 1,
+            simple: bool = False,
+            max_workers: int = None,
+    ) -> typing.Iterator[dict]:
+        """
+        先获取部门 department_id 及其所有子部门，再并发（ max_workers 个线程，默认同 WorkWeChat 的 max_workers ）
+        逐个部门调用 user_list （ simple 为 True 时调用 user_simplelist ），按完成顺序逐个返回成员；
+        属于多个部门的成员只返回一次。部门很多、成员很多时比 user_list(fetch_child=True) 快，也不容易超时。
+        """
+        fetch = self.user_simplelist if simple else self.user_list
+        departments = (i["id"] for i in self.department_list(id=department_id))
+        seen = set()
+        for _, users in _imap_unordered(lambda i: fetch(i, fetch_child=False), departments, max_workers or self._max_workers):
+            if isinstance(users, Exception):
+                raise users
+            for user in users:
+                if user["userid"] not in seen:
+                    seen.add(user["userid"])
+                    yield user
+
+    def _bulk(
+            self,
+            fn: typing.Callable,
+            items: typing.Iterable,
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        bucket = TokenBucket(*rate) if rate else None
+
+        def call(indexed_item):
+            if bucket is not None:
+                bucket.acquire()
+            return fn(indexed_item[1])
+
+        return self._bulk_results(_imap_unordered(call, enumerate(items), max_workers or self._max_workers))
+
+    def user_bulk_get(
+            self,
+            userids: typing.Iterable[str],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """
+        并发调用 user_get ，按 userids 的顺序返回每个成员的 BulkResult ，单个失败不影响其他成员。
+        max_workers: 并发线程数，默认同 WorkWeChat 的 max_workers ；
+        rate: (次数, 秒数)，限制本次批量调用的速度，默认不限制。
+        """
+        return self._bulk(self.user_get, userids, max_workers=max_workers, rate=rate)
+
+    def user_bulk_create(
+            self,
+            users: typing.Iterable[dict],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """
+        并发调用 user_create ，users 中每个元素为 user_create 的参数，返回值同 user_bulk_get 。
+        """
+        return self._bulk(lambda i: self.user_create(**i), users, max_workers=max_workers, rate=rate)
+
+    def user_bulk_update(
+            self,
+            users: typing.Iterable[dict],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """
+        并发调用 user_update ，users 中每个元素为 user_update 的参数（包含 userid ），返回值同 user_bulk_get 。
+        """
+        return self._bulk(lambda i: self.user_update(**i), users, max_workers=max_workers, rate=rate)
+
+    def iter_media_upload(
+            self,
+            medias: typing.Iterable[typing.Union[Media, str, os.PathLike]],
+            max_workers: int = None,
+    ) -> typing.Iterator[typing.Tuple[typing.Union[Media, str, os.PathLike], typing.Union[str, Exception]]]:
+        """
+        并发（ max_workers 个线程，默认同 WorkWeChat 的 max_workers ）上传 medias 中的 Media 或文件路径，
+        按完成顺序逐个返回 (传入的元素, media_id 或异常)，不必等全部上传完成就可以开始发送消息：
+
+            for media, media_id in ww.iter_media_upload(paths):
+                if isinstance(media_id, Exception):
+                    continue
+                ww.message_send(msgtype=MsgType.FILE, media_id=media_id, ...)
+
+        medias 按需读取，提前停止遍历时未开始的上传会被取消。
+        """
+        return _imap_unordered(
+            lambda i: self.media_upload(self._as_media(i)),
+            medias,
+            max_workers or self._max_workers,
+        )
+
+    def _update_access_token(self, margin: int = 0):
+        if not self._access_token_expired(margin) or self._load_access_token(margin):
+            return
+        # 同一时刻只有一个线程调用 /gettoken ，其他线程等待后直接使用新 token
+        with self._access_token_lock:
+            if self._load_access_token(margin):
+                return
+            with self._token_store.lock(self._token_key):
+                # 等锁期间其他进程可能已经刷新过
+                if self._load_access_token(margin):
+                    return
+                self._set_access_token(self.gettoken())
+
+    def _renew_access_token_forever(self):
+        while not self._closed.is_set():
+            try:
+                self._update_access_token(margin=self._token_refresh_margin)
+                delay = max(self._access_token_renew_delay(), 1)
+            except Exception:
+                logging.exception("renew access_token failed")
+                delay = 10
+            self._closed.wait(delay)
+
+    def _start_access_token_renewer(self):
+        with self._access_token_lock:
+            if self._access_token_renewer is not None:
+                return
+            self._access_token_renewer = threading.Thread(
+                target=self._renew_access_token_forever,
+                name="work_wechat-token-renewer",
+                daemon=True,
+            )
+        self._access_token_renewer.start()
+
+    def get_access_token(self) -> str:
+        if self._token_refresh_margin is not None and self._access_token_renewer is None:
+            self._start_access_token_renewer()
+        self._update_access_token()
+        return self._access_token
+
+    def _send_req(
+            self,
+            method: str,
+            path: str,
+            params_qs: dict = None,
+            params_post: dict = None,
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.BinaryIO, str]] = None,
+            body: bytes = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            auto_update_token: bool = True,
+    ) -> dict:
+        if not params_qs:
+            params_qs = dict()
+        cache = self._response_cache
+        cache_key = None
+        if cache is not None:
+            cache_key, rs = cache.lookup(self._token_key, path, params_qs, params_post)
+            if rs is not None:
+                return rs
+        if self._retry_policy is not None:
+            self._retry_policy.deposit()
+        params_post_files, files_start = self._prepare_files(params_post_files)
+
+        attempt = 0
+        tries = 0
+        access_token_invalidated = False
+        while True:
+            request = self._request_started(method, path, params_post, tries)
+            tries += 1
+            try:
+                rs = self._send_req_once(
+                    method=method,
+                    path=path,
+                    params_qs=params_qs,
+                    params_post=params_post,
+                    params_post_files=params_post_files,
+                    body=body,
+                    errcodes_accepted=errcodes_accepted,
+                    auto_update_token=auto_update_token,
+                    marks=None if request is None else request.marks,
+                )
+            except Exception as ex:
+                self._request_finished(request, ex=ex)
+                if auto_update_token and not access_token_invalidated and self._is_access_token_error(ex):
+                    # token 失效时请求没有被处理，刷新 token 后立即重试
+                    access_token_invalidated = True
+                    self._invalidate_access_token(params_qs["access_token"])
+                    self._rewind_files(params_post_files, files_start)
+                    self._request_retried(request, ex, 0)
+                    continue
+
+                delay = self._retry_delay(method, path, attempt, ex)
+                if delay is None:
+                    raise
+                logging.warning("%s %s failed (%r), retry in %.2fs" % (method, path, ex, delay))
+                self._request_retried(request, ex, delay)
+                time.sleep(delay)
+                attempt += 1
+                self._rewind_files(params_post_files, files_start)
+            except BaseException as ex:
+                # 超时取消（CancelledError）等也要结束这次请求，否则并发中的请求数不会减少
+                self._request_finished(request, ex=ex)
+                raise
+            else:
+                self._request_finished(request, rs=rs)
+                if cache is not None:
+                    cache.store(cache_key, rs)
+                    cache.invalidate(self._token_key, path, params_qs, params_post)
+                return rs
+
+    def _send_req_once(
+            self,
+            method: str,
+            path: str,
+            params_qs: dict = None,
+            params_post: dict = None,
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.BinaryIO, str]] = None,
+            body: bytes = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            auto_update_token: bool = True,
+            marks: list = None,
+    ) -> dict:
+        if auto_update_token:
+            params_qs["access_token"] = self.get_access_token()
+        _mark(marks)
+
+        if self._rate_limiter is not None:
+            delay = self._rate_limiter.reserve(path)
+            if delay > 0:
+                time.sleep(delay)
+        _mark(marks)
+
+        url = self._build_url(method, path, params_qs)
+
+        data_post = None
+        headers = None
+        if params_post:
+            data_post = self._json.dumps(params_post)
+        if body is not None:
+            data_post = body
+        if params_post_files:
+            data_post = _MultipartStream(params_post_files)
+            headers = {"Content-Type": data_post.content_type, "Content-Length": str(len(data_post))}
+        _mark(marks)
+
+        try:
+            r = self._session.request(
+                method=method,
+                url=url,
+                timeout=self._http_timeout,
+                data=data_post,
+                headers=headers,
+            )
+        finally:
+            if params_post_files:
+                data_post.close()
+        if r.status_code != 200:
+            raise HTTPStatusError(status_code=r.status_code, headers=r.headers)
+        content = r.content
+        _mark(marks)
+        rs = self._json.loads(content)
+        _mark(marks)
+        return self._check_rs(rs, errcodes_accepted)
+
+
+class AsyncWorkWeChat(_WorkWeChatBase):
+    """
+    基于 aiohttp 的异步客户端，接口与 WorkWeChat 一致，调用时需要 await ：
+
+        async with work_wechat.AsyncWorkWeChat(corpid=corpid, corpsecret=corpsecret) as ww:
+            await ww.message_send(agentid=agentid, content="hello", touser=("zhangsan",), msgtype="text")
+
+    需要安装 aiohttp ： pip install WorkWeChatSDK[async]
+    """
+
+    _CPU_PHASES = ("encode", "decode")
+
+    def __init__(
+            self,
+            corpid: str = None,
+            corpsecret: str = None,
+            verbose: bool = False,
+            http_timeout: int = 5,
+            limit: int = 100,
+            limit_per_host: int = 0,
+            keepalive_timeout: float = 15,
+            session: "aiohttp.ClientSession" = None,
+            token_store: TokenStore = None,
+            token_refresh_margin: int = None,
+            rate_limiter: RateLimiter = None,
+            retry_policy: RetryPolicy = None,
+            max_workers: int = 8,
+            directory_cache: DirectoryCache = None,
+            id_cache: IdCache = None,
+            response_cache: ResponseCache = None,
+            media_cache: MediaCache = None,
+            json_codec: JsonCodec = None,
+            metrics: Metrics = None,
+            hooks: typing.Sequence[RequestHooks] = None,
+    ):
+        """
+        limit: 连接池总连接数上限，并发请求超过上限时在事件循环内排队等待，0 为不限制；
+        limit_per_host: 每个 host 的连接数上限，0 为不限制；
+        keepalive_timeout: 空闲连接保持时间（秒）；
+        session: 自定义 aiohttp.ClientSession ，传入后连接池参数无效，且 close() 不会关闭它；
+        token_store: 同 WorkWeChat ，存储操作是同步的，FileTokenStore 刷新时的文件锁会短暂阻塞事件循环；
+        token_refresh_margin: 同 WorkWeChat ，由后台 Task 刷新；
+        rate_limiter: 同 WorkWeChat ，超出频率的请求在事件循环中 sleep 等待；
+        retry_policy: 同 WorkWeChat ；
+        max_workers: message_broadcast 等批量接口的并发请求数；
+        directory_cache: 同 WorkWeChat ；
+        id_cache: 同 WorkWeChat ，缓存读写是同步的；
+        response_cache: 同 WorkWeChat ；
+        media_cache: 同 WorkWeChat ，计算文件 sha256 时会阻塞事件循环；
+        json_codec: 同 WorkWeChat ；
+        metrics: 同 WorkWeChat ；
+        hooks: 同 WorkWeChat ，钩子在事件循环中调用。
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncWorkWeChat requires aiohttp, install it by `pip install aiohttp`")
+
+        super().__init__(
+            corpid=corpid,
+            corpsecret=corpsecret,
+            verbose=verbose,
+            http_timeout=http_timeout,
+            token_store=token_store,
+            token_refresh_margin=token_refresh_margin,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            max_workers=max_workers,
+            directory_cache=directory_cache,
+            id_cache=id_cache,
+            response_cache=response_cache,
+            media_cache=media_cache,
+            json_codec=json_codec,
+            metrics=metrics,
+            hooks=hooks,
+        )
+
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+
+        self._session_owned = session is None
+        self._session = session
+
+        self._access_token_lock = None
+        self._access_token_renewer = None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        # aiohttp.ClientSession 需要在事件循环中创建，所以延迟到第一次请求
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._access_token_renewer is not None:
+            self._access_token_renewer.cancel()
+            self._access_token_renewer = None
+        if self._session_owned and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def _run_plan(self, plan: typing.Generator):
+        try:
+            req = next(plan)
+            while True:
+                try:
+                    if isinstance(req, list):
+                        rs = await self._run_concurrently(req)
+                    elif isinstance(req, concurrent.futures.Future):
+                        # 其他调用共享的 Future ，当前协程被取消时不能取消它
+                        rs = await asyncio.shield(asyncio.wrap_future(req))
+                    else:
+                        rs = await self._send_req(**req)
+                except BaseException as ex:
+                    # 协程被取消时 CancelledError 也交给 plan 处理，plan 可以在抛出前清理状态
+                    req = plan.throw(ex)
+                    continue
+                req = plan.send(rs)
+        except StopIteration as ex:
+            return ex.value
+
+    async def _run_concurrently(self, items: typing.List[typing.Union[dict, typing.Generator]]) -> list:
+        semaphore = asyncio.Semaphore(self._max_workers)
+
+        async def run(item):
+            async with semaphore:
+                if isinstance(item, dict):
+                    return await self._send_req(**item)
+                return await self._run_plan(item)
+
+        return await asyncio.gather(*[run(i) for i in items], return_exceptions=True)
+
+    def _transport_error_processed(self, ex: Exception) -> typing.Optional[bool]:
+        if isinstance(ex, aiohttp.ClientConnectorError):
+            return False
+        if isinstance(ex, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return True
+        return None
+
+    async def _send_req_stream(
+            self,
+            method: str,
+            path: str,
+            field: str,
+            params_qs: dict = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+    ) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat._send_req_stream"""
+        if not params_qs:
+            params_qs = dict()
+        if self._retry_policy is not None:
+            self._retry_policy.deposit()
+
+        attempt = 0
+        tries = 0
+        access_token_invalidated = False
+        yielded = False
+        while True:
+            request = self._request_started(method, path, None, tries)
+            tries += 1
+            parser = _JsonArrayStream(field)
+            try:
+                async for i in self._send_req_stream_once(
+                        method=method,
+                        path=path,
+                        parser=parser,
+                        params_qs=params_qs,
+                        errcodes_accepted=errcodes_accepted,
+                        marks=None if request is None else request.marks,
+                ):
+                    yielded = True
+                    yield i
+            except Exception as ex:
+                self._request_finished(request, ex=ex)
+                if yielded:
+                    raise
+                if not access_token_invalidated and self._is_access_token_error(ex):
+                    access_token_invalidated = True
+                    self._invalidate_access_token(params_qs["access_token"])
+                    self._request_retried(request, ex, 0)
+                    continue
+
+                delay = self._retry_delay(method, path, attempt, ex)
+                if delay is None:
+                    raise
+                logging.warning("%s %s failed (%r), retry in %.2fs" % (method, path, ex, delay))
+                self._request_retried(request, ex, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            except GeneratorExit:
+                # 调用方提前结束遍历，不是请求失败
+                self._request_finished(request, rs=parser.envelope)
+                raise
+            except BaseException as ex:
+                # 取消（CancelledError）、KeyboardInterrupt 等
+                self._request_finished(request, ex=ex)
+                raise
+            else:
+                self._request_finished(request, rs=parser.envelope)
+                return
+
+    async def _send_req_stream_once(
+            self,
+            method: str,
+            path: str,
+            parser: _JsonArrayStream,
+            params_qs: dict,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            marks: list = None,
+    ) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat._send_req_stream_once"""
+        params_qs["access_token"] = await self.get_access_token()
+        _mark(marks)
+
+        if self._rate_limiter is not None:
+            delay = self._rate_limiter.reserve(path)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        _mark(marks)
+
+        url = self._build_url(method, path, params_qs)
+        _mark(marks)
+
+        async with self._get_session().request(
+                method=method,
+                url=url,
+                timeout=aiohttp.ClientTimeout(total=self._http_timeout),
+        ) as r:
+            if r.status != 200:
+                raise HTTPStatusError(status_code=r.status, headers=r.headers)
+            _mark(marks)
+            async for chunk in r.content.iter_chunked(STREAM_CHUNK_SIZE):
+                for i in parser.feed(chunk):
+                    if marks is None:
+                        yield i
+                        continue
+                    paused = _pause(marks)
+                    yield i
+                    _resume(marks, paused)
+            parser.finish()
+        _mark(marks)
+        self._check_rs(parser.envelope, errcodes_accepted)
+
+    async def iter_user_list(self, department_id: int, fetch_child: bool = False) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat.iter_user_list ，使用 async for 遍历"""
+        req = self._user_list_stream_req("/user/list", department_id, fetch_child)
+        users = self._send_req_stream(**req)
+        try:
+            async for user in users:
+                if self._directory_cache is not None:
+                    self._directory_cache.put_snapshot((user,))
+                yield user
+        finally:
+            # 调用方提前结束遍历时立即结束请求，异步生成器不会像同步生成器那样被及时回收
+            await users.aclose()
+
+    def iter_user_simplelist(self, department_id: int, fetch_child: bool = False) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat.iter_user_simplelist ，使用 async for 遍历"""
+        req = self._user_list_stream_req("/user/simplelist", department_id, fetch_child)
+        return self._send_req_stream(**req)
+
+    async def iter_user_list_id(self, limit: int = 10000) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat.iter_user_list_id ，使用 async for 遍历"""
+        cursor = None
+        while True:
+            rs = await self.user_list_id(cursor=cursor, limit=limit)
+            for i in rs["dept_user"]:
+                yield i
+            cursor = rs["next_cursor"]
+            if not cursor:
+                return
+
+    async def iter_department_users(
+            self,
+            department_id: int = 1,
+            simple: bool = False,
+            max_workers: int = None,
+    ) -> typing.AsyncIterator[dict]:
+        """同 WorkWeChat.iter_department_users ，使用 async for 遍历"""
+        fetch = self.user_simplelist if simple else self.user_list
+        departments = (i["id"] for i in await self.department_list(id=department_id))
+        seen = set()
+        async for _, users in _aimap_unordered(
+                lambda i: fetch(i, fetch_child=False),
+                departments,
+                max_workers or self._max_workers,
+        ):
+            if isinstance(users, Exception):
+                raise users
+            for user in users:
+                if user["userid"] not in seen:
+                    seen.add(user["userid"])
+                    yield user
+
+    async def _bulk(
+            self,
+            fn: typing.Callable,
+            items: typing.Iterable,
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        bucket = TokenBucket(*rate) if rate else None
+
+        async def call(indexed_item):
+            if bucket is not None:
+                delay = bucket.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            return await fn(indexed_item[1])
+
+        results = [i async for i in _aimap_unordered(call, enumerate(items), max_workers or self._max_workers)]
+        return self._bulk_results(results)
+
+    async def user_bulk_get(
+            self,
+            userids: typing.Iterable[str],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """同 WorkWeChat.user_bulk_get"""
+        return await self._bulk(self.user_get, userids, max_workers=max_workers, rate=rate)
+
+    async def user_bulk_create(
+            self,
+            users: typing.Iterable[dict],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """同 WorkWeChat.user_bulk_create"""
+        return await self._bulk(lambda i: self.user_create(**i), users, max_workers=max_workers, rate=rate)
+
+    async def user_bulk_update(
+            self,
+            users: typing.Iterable[dict],
+            max_workers: int = None,
+            rate: typing.Tuple[int, float] = None,
+    ) -> typing.List[BulkResult]:
+        """同 WorkWeChat.user_bulk_update"""
+        return await self._bulk(lambda i: self.user_update(**i), users, max_workers=max_workers, rate=rate)
+
+    async def iter_media_upload(
+            self,
+            medias: typing.Iterable[typing.Union[Media, str, os.PathLike]],
+            max_workers: int = None,
+    ) -> typing.AsyncIterator[typing.Tuple[typing.Union[Media, str, os.PathLike], typing.Union[str, Exception]]]:
+        """同 WorkWeChat.iter_media_upload ，使用 async for 遍历"""
+        async for item in _aimap_unordered(
+                lambda i: self.media_upload(self._as_media(i)),
+                medias,
+                max_workers or self._max_workers,
+        ):
+            yield item
+
+    async def _update_access_token(self, margin: int = 0):
+        if not self._access_token_expired(margin) or self._load_access_token(margin):
+            return
+        if self._access_token_lock is None:
+            self._access_token_lock = asyncio.Lock()
+        # 同一个客户端内先在协程间排队，只有一个协程等待 token_store.lock()
+        async with self._access_token_lock:
+            if self._load_access_token(margin):
+                return
+            await self._refresh_access_token(margin)
+
+    async def _refresh_access_token(self, margin: int):
+        # token_store.lock() 是阻塞锁，在线程池中等待，否则共用同一个 FileTokenStore 的其他客户端持锁 await 时会卡死事件循环
+        lock = self._token_store.lock(self._token_key)
+        acquiring = asyncio.get_event_loop().run_in_executor(None, lock.__enter__)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(self._release_acquired_lock(lock))
+            raise
+        try:
+            # 等锁期间其他进程可能已经刷新过
+            if self._load_access_token(margin):
+                return
+            self._set_access_token(await self.gettoken())
+        finally:
+            lock.__exit__(None, None, None)
+
+    @staticmethod
+    def _release_acquired_lock(lock: typing.ContextManager) -> typing.Callable[[asyncio.Future], None]:
+        """等锁的协程被取消后，线程池中最终拿到的锁立即释放"""
+
+        def callback(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is None:
+                lock.__exit__(None, None, None)
+
+        return callback
+
+    async def _renew_access_token_forever(self):
+        while True:
+            try:
+                await self._update_access_token(margin=self._token_refresh_margin)
+                delay = max(self._access_token_renew_delay(), 1)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("renew access_token failed")
+                delay = 10
+            await asyncio.sleep(delay)
+
+    async def get_access_token(self) -> str:
+        if self._token_refresh_margin is not None and self._access_token_renewer is None:
+            self._access_token_renewer = asyncio.ensure_future(self._renew_access_token_forever())
+        await self._update_access_token()
+        return self._access_token
+
+    async def _send_req(
+            self,
+            method: str,
+            path: str,
+            params_qs: dict = None,
+            params_post: dict = None,
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.BinaryIO, str]] = None,
+            body: bytes = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            auto_update_token: bool = True,
+    ) -> dict:
+        if not params_qs:
+            params_qs = dict()
+        cache = self._response_cache
+        cache_key = None
+        if cache is not None:
+            cache_key, rs = cache.lookup(self._token_key, path, params_qs, params_post)
+            if rs is not None:
+                return rs
+        if self._retry_policy is not None:
+            self._retry_policy.deposit()
+        params_post_files, files_start = self._prepare_files(params_post_files)
+
+        attempt = 0
+        tries = 0
+        access_token_invalidated = False
+        while True:
+            request = self._request_started(method, path, params_post, tries)
+            tries += 1
+            try:
+                rs = await self._send_req_once(
+                    method=method,
+                    path=path,
+                    params_qs=params_qs,
+                    params_post=params_post,
+                    params_post_files=params_post_files,
+                    body=body,
+                    errcodes_accepted=errcodes_accepted,
+                    auto_update_token=auto_update_token,
+                    marks=None if request is None else request.marks,
+                )
+            except Exception as ex:
+                self._request_finished(request, ex=ex)
+                if auto_update_token and not access_token_invalidated and self._is_access_token_error(ex):
+                    # token 失效时请求没有被处理，刷新 token 后立即重试
+                    access_token_invalidated = True
+                    self._invalidate_access_token(params_qs["access_token"])
+                    self._rewind_files(params_post_files, files_start)
+                    self._request_retried(request, ex, 0)
+                    continue
+
+                delay = self._retry_delay(method, path, attempt, ex)
+                if delay is None:
+                    raise
+                logging.warning("%s %s failed (%r), retry in %.2fs" % (method, path, ex, delay))
+                self._request_retried(request, ex, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+                self._rewind_files(params_post_files, files_start)
+            except BaseException as ex:
+                # 超时取消（CancelledError）等也要结束这次请求，否则并发中的请求数不会减少
+                self._request_finished(request, ex=ex)
+                raise
+            else:
+                self._request_finished(request, rs=rs)
+                if cache is not None:
+                    cache.store(cache_key, rs)
+                    cache.invalidate(self._token_key, path, params_qs, params_post)
+                return rs
+
+    async def _send_req_once(
+            self,
+            method: str,
+            path: str,
+            params_qs: dict = None,
+            params_post: dict = None,
+            params_post_files: typing.Dict[str, typing.Tuple[str, typing.BinaryIO, str]] = None,
+            body: bytes = None,
+            errcodes_accepted: typing.Tuple[int, ...] = None,
+            auto_update_token: bool = True,
+            marks: list = None,
+    ) -> dict:
+        if auto_update_token:
+            params_qs["access_token"] = await self.get_access_token()
+        _mark(marks)
+
+        if self._rate_limiter is not None:
+            delay = self._rate_limiter.reserve(path)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        _mark(marks)
+
+        url = self._build_url(method, path, params_qs)
+
+        data_post = None
+        headers = None
+        stream = None
+        if params_post:
+            data_post = self._json.dumps(params_post)
+        if body is not None:
+            data_post = body
+        if params_post_files:
+            stream = _MultipartStream(params_post_files)
+            data_post = self._read_stream(stream)
+            headers = {"Content-Type": stream.content_type, "Content-Length": str(len(stream))}
+        _mark(marks)
+
+        try:
+            async with self._get_session().request(
+                    method=method,
+                    url=url,
+                    timeout=aiohttp.ClientTimeout(total=self._http_timeout),
+                    data=data_post,
+                    headers=headers,
+            ) as r:
+                if r.status != 200:
+                    raise HTTPStatusError(status_code=r.status, headers=r.headers)
+                content = await r.read()
+                _mark(marks)
+                rs = self._json.loads(content)
+                _mark(marks)
+        finally:
+            if stream is not None:
+                stream.close()
+        return self._check_rs(rs, errcodes_accepted)
+
+    @staticmethod
+    async def _read_stream(stream: _MultipartStream) -> typing.AsyncIterator[bytes]:
+        # 读文件可能阻塞，放到线程池中执行
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, stream.read, STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class OverflowPolicy:
+    RAISE = "raise"  # 队列满时抛出 queue.Full
+    BLOCK = "block"  # 队列满时阻塞等待，最多等待 put_timeout 秒，超时抛出 queue.Full
+    DROP = "drop"  # 队列满时丢弃消息，返回的 Future 为 queue.Full 异常
+
+
+class _DispatchJob(object):
+    def __init__(self, kind: str, kwargs: dict):
+        self.kind = kind
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+
+
+_DISPATCH_STOP = object()
+
+
+class MessageDispatcher(object):
+    """
+    后台发送应用消息和群聊消息，调用方不再等待企业微信接口：
+
+        dispatcher = work_wechat.MessageDispatcher(ww, workers=4, maxsize=10000)
+        future = dispatcher.message_send(agentid=agentid, msgtype="text", content="hello", touser=("zhangsan",))
+        rs = future.result()  # 可选，等待发送结果，同 message_send 的返回值
+        dispatcher.close()
+
+    消息放入有界队列后立即返回 concurrent.futures.Future ，由 workers 个后台线程取出发送；
+    积压时每个线程一次最多取出 batch_size 条，其中除接收人外参数完全相同的 message_send 合并为一次多接收人发送（接收人去重，
+    超过接口的接收人上限时分多次发送），各自的 Future 返回这次发送的 message_send 结果，其中 invaliduser 等只包含自己的接收人。
+    队列满时按 overflow 处理，见 OverflowPolicy 。
+    """
+
+    def __init__(
+            self,
+            ww: "WorkWeChat",
+            workers: int = 4,
+            maxsize: int = 1000,
+            batch_size: int = 100,
+            overflow: str = OverflowPolicy.RAISE,
+            put_timeout: float = None,
+    ):
+        self._ww = ww
+        self._batch_size = batch_size
+        self._overflow = overflow
+        self._put_timeout = put_timeout
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        # close() 等正在入队的消息都放入队列后再放入结束标记，之后不会再有消息入队
+        self._cond = threading.Condition()
+        self._putting = 0
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, name="work_wechat-dispatcher-%d" % i, daemon=True)
+            for i in range(workers)
+        ]
+        for i in self._threads:
+            i.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def message_send(self, **kwargs) -> concurrent.futures.Future:
+        """参数同 WorkWeChat.message_send"""
+        return self._put(_DispatchJob("message_send", kwargs))
+
+    def appchat_send(self, chatid: str, content: str) -> concurrent.futures.Future:
+        """参数同 WorkWeChat.appchat_send"""
+        return self._put(_DispatchJob("appchat_send", dict(chatid=chatid, content=content)))
+
+    def _put(self, job: _DispatchJob) -> concurrent.futures.Future:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("dispatcher is closed")
+            self._putting += 1
+        # 阻塞等待队列空间时不持有锁，多个生产者各自等待
+        try:
+            if self._overflow == OverflowPolicy.BLOCK:
+                self._queue.put(job, timeout=self._put_timeout)
+            else:
+                self._queue.put_nowait(job)
+        except queue.Full as ex:
+            if self._overflow != OverflowPolicy.DROP:
+                raise
+            logging.warning("dispatcher queue is full, drop %s %s" % (job.kind, job.kwargs))
+            job.future.set_exception(ex)
+        finally:
+            with self._cond:
+                self._putting -= 1
+                self._cond.notify_all()
+        return job.future
+
+    def close(self, wait: bool = True):
+        """不再接受新消息，队列中已有的消息发送完后后台线程退出"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            # 后台线程仍在取消息，阻塞中的生产者会陆续入队或超时
+            self._cond.wait_for(lambda: not self._putting)
+        for _ in self._threads:
+            self._queue.put(_DISPATCH_STOP)
+        if wait:
+            for i in self._threads:
+                i.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is _DISPATCH_STOP:
+                return
+            batch = [job]
+            stop = False
+            while len(batch) < self._batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _DISPATCH_STOP:
+                    stop = True
+                    break
+                batch.append(job)
+
+            try:
+                self._dispatch(batch)
+            except Exception:
+                logging.exception("dispatch messages failed")
+            if stop:
+                return
+
+    def _dispatch(self, batch: typing.List[_DispatchJob]):
+        groups = collections.OrderedDict()
+        for job in batch:
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            if job.kind == "message_send" and not self._is_mergeable(job.kwargs):
+                groups[id(job)] = [job]
+                continue
+            groups.setdefault(self._group_key(job), []).append(job)
+
+        for jobs in groups.values():
+            if len(jobs) == 1:
+                self._send_one(jobs[0])
+            else:
+                self._send_merged(jobs)
+
+    @staticmethod
+    def _is_mergeable(kwargs: dict) -> bool:
+        return "@all" not in (kwargs.get("touser") or ())
+
+    def _group_key(self, job: _DispatchJob):
+        if job.kind != "message_send":
+            return id(job)
+        kwargs = dict((k, v) for k, v in job.kwargs.items() if k not in ("touser", "toparty", "totag"))
+        try:
+            return json.dumps(self._ww._message_send_data(**kwargs), sort_keys=True, default=_json_default)
+        except Exception:
+            # 参数有误，单独发送，把异常交给 message_send 抛出
+            return id(job)
+
+    def _send_one(self, job: _DispatchJob):
+        try:
+            rs = getattr(self._ww, job.kind)(**job.kwargs)
+        except Exception as ex:
+            job.future.set_exception(ex)
+        else:
+            job.future.set_result(rs)
+
+    _RECIPIENT_LIMITS = (
+        ("touser", "invaliduser", MESSAGE_MAX_TOUSER),
+        ("toparty", "invalidparty", MESSAGE_MAX_TOPARTY),
+        ("totag", "invalidtag", MESSAGE_MAX_TOTAG),
+    )
+
+    def _send_merged(self, jobs: typing.List[_DispatchJob]):
+        """按接口的接收人上限把 jobs 分成尽量少的几次 message_send"""
+        batch = []
+        merged = None
+        for job in jobs:
+            if batch and not self._fits(merged, job):
+                self._send_batch(batch, merged)
+                batch = []
+            if not batch:
+                merged = dict((field, collections.OrderedDict()) for field, _, _ in self._RECIPIENT_LIMITS)
+            batch.append(job)
+            for field, _, _ in self._RECIPIENT_LIMITS:
+                for i in job.kwargs.get(field) or ():
+                    merged[field][i] = None
+        if batch:
+            self._send_batch(batch, merged)
+
+    def _fits(self, merged: typing.Dict[str, collections.OrderedDict], job: _DispatchJob) -> bool:
+        return all(
+            len(merged[field]) + len(set(job.kwargs.get(field) or ()).difference(merged[field])) <= limit
+            for field, _, limit in self._RECIPIENT_LIMITS
+        )
+
+    def _send_batch(self, jobs: typing.List[_DispatchJob], merged: typing.Dict[str, collections.OrderedDict]):
+        if len(jobs) == 1:
+            self._send_one(jobs[0])
+            return
+
+        kwargs = dict(jobs[0].kwargs)
+        kwargs.update((field, tuple(recipients)) for field, recipients in merged.items())
+        try:
+            rs = self._ww.message_send(**kwargs)
+        except Exception as ex:
+            for job in jobs:
+                job.future.set_exception(ex)
+            return
+
+        for job in jobs:
+            job_rs = dict(rs)
+            for field, invalid_field, _ in self._RECIPIENT_LIMITS:
+                if job_rs.get(invalid_field):
+                    invalid = set(job_rs[invalid_field].split("|"))
+                    job_rs[invalid_field] = "|".join(i for i in job.kwargs.get(field) or () if i in invalid)
+            job.future.set_result(job_rs)
+
+
+class WebhookDispatcher(object):
+    """
+    后台发送群机器人消息，按机器人 key 限流（默认每个 key 20 条/分钟），超出频率的消息排队等待：
+
+        dispatcher = work_wechat.WebhookDispatcher(work_wechat.WorkWeChat())
+        future = dispatcher.webhook_send(key=webhook_key, text_content="CPU 使用率超过 90%")
+        dispatcher.close()
+
+    参数同 WorkWeChat.webhook_send ，返回 concurrent.futures.Future 。
+    排队期间同一个 key 连续的文本消息（或 markdown 消息）会合并为一条发送，合并后内容不超过接口限制
+    （文本 2048 字节，markdown 4096 字节），文本消息的 mentioned_list 等取并集；告警风暴时消息不会因为频率限制被拒绝。
+    队列满时按 overflow 处理，见 OverflowPolicy 。
+    """
+
+    SEPARATORS = dict(text="\n", markdown="\n\n")
+
+    def __init__(
+            self,
+            ww: "WorkWeChat",
+            rate: typing.Tuple[int, float] = (20, 60),
+            workers: int = 4,
+            maxsize: int = 10000,
+            overflow: str = OverflowPolicy.RAISE,
+            put_timeout: float = None,
+            coalesce: bool = True,
+    ):
+        self._ww = ww
+        self._rate = rate
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._put_timeout = put_timeout
+        self._coalesce = coalesce
+
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._size = 0
+        self._buckets = dict()
+        self._busy = set()
+        self._closed = False
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._thread = threading.Thread(target=self._schedule, name="work_wechat-webhook-dispatcher", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def webhook_send(self, key: str, **kwargs) -> concurrent.futures.Future:
+        key = _WorkWeChatBase._parse_webhook_key(key)
+        job = _DispatchJob("webhook_send", kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("dispatcher is closed")
+            if self._size >= self._maxsize:
+                if self._overflow == OverflowPolicy.BLOCK:
+                    if not self._cond.wait_for(lambda: self._closed or self._size < self._maxsize,
+                                               timeout=self._put_timeout):
+                        raise queue.Full
+                    # 等待期间可能已经 close ，后台线程退出后入队的消息不会再发送
+                    if self._closed:
+                        raise RuntimeError("dispatcher is closed")
+                elif self._overflow == OverflowPolicy.DROP:
+                    logging.warning("webhook dispatcher queue is full, drop %s" % kwargs)
+                    job.future.set_exception(queue.Full())
+                    return job.future
+                else:
+                    raise queue.Full
+            self._pending.setdefault(key, collections.deque()).append(job)
+            self._size += 1
+            self._cond.notify_all()
+        return job.future
+
+    def close(self, wait: bool = True):
+        """不再接受新消息，队列中已有的消息发送完后后台线程退出"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            count, period = self._rate
+            bucket = self._buckets[key] = TokenBucket(count=count, period=period)
+        return bucket
+
+    def _schedule(self):
+        with self._cond:
+            while True:
+                if self._closed and not self._size and not self._busy:
+                    break
+                ready = None
+                timeout = None
+                for key in self._pending:
+                    if key in self._busy:
+                        continue
+                    wait = self._bucket(key).wait_time()
+                    if wait <= 0:
+                        ready = key
+                        break
+                    timeout = wait if timeout is None else min(timeout, wait)
+                if ready is None:
+                    self._cond.wait(timeout)
+                    continue
+
+                jobs = self._take(ready)
+                self._busy.add(ready)
+                self._bucket(ready).reserve()
+                self._executor.submit(self._send, ready, jobs)
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _msgtype(kwargs: dict) -> typing.Optional[str]:
+        """可以合并的消息返回 text/markdown ，其他返回 None"""
+        if kwargs.get("image_base64") or kwargs.get("image") is not None or kwargs.get("news_articles"):
+            return None
+        if kwargs.get("text_content") and not kwargs.get("markdown_content"):
+            return MsgType.TEXT
+        if kwargs.get("markdown_content") and not kwargs.get("text_content"):
+            return MsgType.MARKDOWN
+        return None
+
+    def _take(self, key: str) -> typing.List[_DispatchJob]:
+        """取出 key 下一次要发送的消息，连续的同类型文本消息在不超过长度限制时一起取出"""
+        pending = self._pending[key]
+        jobs = [pending.popleft()]
+        msgtype = self._msgtype(jobs[0].kwargs)
+        if self._coalesce and msgtype is not None:
+            field = msgtype + "_content"
+            max_bytes = WEBHOOK_TEXT_MAX_BYTES if msgtype == MsgType.TEXT else WEBHOOK_MARKDOWN_MAX_BYTES
+            sep_bytes = len(self.SEPARATORS[msgtype].encode("utf8"))
+            size = len(jobs[0].kwargs[field].encode("utf8"))
+            while pending and self._msgtype(pending[0].kwargs) == msgtype:
+                size_next = size + sep_bytes + len(pending[0].kwargs[field].encode("utf8"))
+                if size_next > max_bytes:
+                    break
+                jobs.append(pending.popleft())
+                size = size_next
+
+        self._size -= len(jobs)
+        if pending:
+            self._pending.move_to_end(key)
+        else:
+            del self._pending[key]
+        self._cond.notify_all()
+        return jobs
+
+    def _merge(self, jobs: typing.List[_DispatchJob]) -> dict:
+        if len(jobs) == 1:
+            return jobs[0].kwargs
+        msgtype = self._msgtype(jobs[0].kwargs)
+        field = msgtype + "_content"
+        kwargs = {field: self.SEPARATORS[msgtype].join(i.kwargs[field] for i in jobs)}
+        if msgtype == MsgType.TEXT:
+            for mentioned in ("mentioned_list", "mentioned_mobile_list"):
+                merged = collections.OrderedDict()
+                for job in jobs:
+                    for i in job.kwargs.get(mentioned) or ():
+                        merged[i] = None
+                if merged:
+                    kwargs[mentioned] = list(merged)
+        return kwargs
+
+    def _send(self, key: str, jobs: typing.List[_DispatchJob]):
+        try:
+            jobs = [i for i in jobs if i.future.set_running_or_notify_cancel()]
+            if not jobs:
+                return
+            try:
+                self._ww.webhook_send(key=key, **self._merge(jobs))
+            except Exception as ex:
+                for i in jobs:
+                    i.future.set_exception(ex)
+            else:
+                for i in jobs:
+                    i.future.set_result(None)
+        finally:
+            with self._cond:
+                self._busy.discard(key)
+                self._cond.notify_all()